@@ -1,16 +1,246 @@
 from flask import Flask, send_file, Response, request, jsonify
+import argparse
+import asyncio
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from io import BytesIO
 import math
+import gzip
+import hashlib
+import shutil
+import sqlite3
+import json
 import logging
 import geoip2.database
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+    Image = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import os
+import sys
+import mmap
+import random
+import struct
+import threading
+import time
+import atexit
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as futures_wait
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
+from werkzeug.http import http_date
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ===== 配置 =====
+def env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+# 磁盘缓存
+CACHE_ENABLED = env_bool("CACHE_ENABLED")
+CACHE_DIR = os.environ.get("CACHE_DIR", "/tmp/cache")
+CACHE_MAX_BYTES = env_int("CACHE_MAX_BYTES", 2 * 1024 ** 3)
+CACHE_TTL = env_int("CACHE_TTL", 7 * 24 * 3600)
+
+# 浏览器 / CDN 缓存时间（秒）
+TILE_MAX_AGE = env_int("TILE_MAX_AGE", 86400)
+
+# 进程内热点缓存（0 表示关闭）
+MEMORY_CACHE_BYTES = env_int("MEMORY_CACHE_BYTES", 64 * 1024 ** 2)
+
+# 负缓存：上游 404 / 内容无效的瓦片缓存 NEGATIVE_CACHE_TTL 秒，上游错误缓存 NEGATIVE_ERROR_TTL 秒（条目数为 0 表示关闭）
+# 空白瓦片（海洋、无覆盖区域）按内容去重后常驻内存：通过校验、不超过 BLANK_TILE_MAX_BYTES，
+# 且解码后为纯色（各通道最大最小值之差不超过 BLANK_TILE_TOLERANCE）的瓦片
+NEGATIVE_CACHE_SIZE = env_int("NEGATIVE_CACHE_SIZE", 200000)
+NEGATIVE_CACHE_TTL = env_int("NEGATIVE_CACHE_TTL", 3600)
+NEGATIVE_ERROR_TTL = env_int("NEGATIVE_ERROR_TTL", 30)
+BLANK_TILE_MAX_BYTES = env_int("BLANK_TILE_MAX_BYTES", 4096)
+BLANK_TILE_TOLERANCE = env_int("BLANK_TILE_TOLERANCE", 8)
+
+# 多进程服务（--mode gunicorn）：工作进程数、每进程线程数，以及跨进程回源锁的条带数
+SERVER_WORKERS = env_int("WORKERS", os.cpu_count() or 1)
+SERVER_THREADS = env_int("WORKER_THREADS", 16)
+SERVER_WORKER_CLASS = os.environ.get("WORKER_CLASS", "gthread")
+CACHE_LOCK_STRIPES = env_int("CACHE_LOCK_STRIPES", 1024)
+
+# 上游连接池
+UPSTREAM_POOL_SIZE = env_int("UPSTREAM_POOL_SIZE", 16)
+UPSTREAM_CONNECT_TIMEOUT = env_float("UPSTREAM_CONNECT_TIMEOUT", 3.05)
+UPSTREAM_READ_TIMEOUT = env_float("UPSTREAM_READ_TIMEOUT", 15)
+UPSTREAM_RETRIES = env_int("UPSTREAM_RETRIES", 2)
+UPSTREAM_BACKOFF = env_float("UPSTREAM_BACKOFF", 0.2)
+UPSTREAM_ASYNC_MAX_CONNECTIONS = env_int("UPSTREAM_ASYNC_MAX_CONNECTIONS", 256)
+
+# 上游健康检查、熔断与对冲请求
+UPSTREAM_HEALTH_WINDOW = env_int("UPSTREAM_HEALTH_WINDOW", 200)
+UPSTREAM_BREAKER_FAILURES = env_int("UPSTREAM_BREAKER_FAILURES", 5)
+UPSTREAM_BREAKER_COOLDOWN = env_float("UPSTREAM_BREAKER_COOLDOWN", 30)
+UPSTREAM_SLOW_FACTOR = env_float("UPSTREAM_SLOW_FACTOR", 3.0)
+UPSTREAM_HEDGE = env_bool("UPSTREAM_HEDGE", True)
+UPSTREAM_HEDGE_MIN_DELAY = env_float("UPSTREAM_HEDGE_MIN_DELAY", 0.05)
+UPSTREAM_HEDGE_MAX_DELAY = env_float("UPSTREAM_HEDGE_MAX_DELAY", 2.0)
+UPSTREAM_HEDGE_WORKERS = env_int("UPSTREAM_HEDGE_WORKERS", 256)
+
+# 上游准入控制：全局与单服务器并发上限，超出时排队（有界、前台优先），等待超时即放弃
+UPSTREAM_MAX_CONCURRENCY = env_int("UPSTREAM_MAX_CONCURRENCY", 64)
+UPSTREAM_HOST_CONCURRENCY = env_int("UPSTREAM_HOST_CONCURRENCY", UPSTREAM_POOL_SIZE)
+UPSTREAM_QUEUE_SIZE = env_int("UPSTREAM_QUEUE_SIZE", 256)
+UPSTREAM_QUEUE_TIMEOUT = env_float("UPSTREAM_QUEUE_TIMEOUT", 2.0)
+
+# 重投影模式：tile = 整瓦片映射（默认）；pixel = 拼接上游瓦片并逐像素重采样（需要 numpy、Pillow）
+REPROJECT_MODE = os.environ.get("REPROJECT_MODE", "tile")
+REPROJECT_GRID_CACHE = env_int("REPROJECT_GRID_CACHE", 256)
+REPROJECT_JPEG_QUALITY = env_int("REPROJECT_JPEG_QUALITY", 90)
+REPROJECT_FETCH_WORKERS = env_int("REPROJECT_FETCH_WORKERS", 16)
+
+# 跨级合成（需要 numpy、Pillow）：超过上游最大级别的瓦片由祖先瓦片裁剪放大；上游没有可用瓦片时用已缓存的祖先或子瓦片补位
+UPSTREAM_MAX_ZOOM = env_int("UPSTREAM_MAX_ZOOM", 18)
+SYNTH_MAX_LEVELS = min(env_int("SYNTH_MAX_LEVELS", 4), 8)
+SYNTH_UNDERZOOM = env_bool("SYNTH_UNDERZOOM", False)
+
+# 按 Accept 头返回 WebP/AVIF（需要 Pillow）：TILE_FORMATS 为逗号分隔的可选格式，靠前的优先，留空时只返回 JPEG
+TILE_FORMATS = [fmt.strip().lower() for fmt in os.environ.get("TILE_FORMATS", "").split(",") if fmt.strip()]
+TRANSCODE_QUALITY = env_int("TRANSCODE_QUALITY", 75)
+TRANSCODE_WORKERS = env_int("TRANSCODE_WORKERS", os.cpu_count() or 2)
+TRANSCODE_CACHE_BYTES = env_int("TRANSCODE_CACHE_BYTES", 64 * 1024 ** 2)
+
+# 批量下载接口：单次请求的瓦片数上限、每个请求同时获取的瓦片数、所有批量请求共享的线程数
+BATCH_MAX_TILES = env_int("BATCH_MAX_TILES", 10000)
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", 16)
+BATCH_WORKERS = env_int("BATCH_WORKERS", 64)
+
+# 坐标转换
+GCJ_INVERSE_MAX_ITER = env_int("GCJ_INVERSE_MAX_ITER", 30)
+GCJ_INVERSE_TOLERANCE = env_float("GCJ_INVERSE_TOLERANCE", 1e-9)
+CONVERT_CHUNK_POINTS = env_int("CONVERT_CHUNK_POINTS", 65536)
+
+# 瓦片映射索引
+TILE_INDEX_ARRAY_MAX_ZOOM = env_int("TILE_INDEX_ARRAY_MAX_ZOOM", 13)
+TILE_INDEX_MEMO_SIZE = env_int("TILE_INDEX_MEMO_SIZE", 200000)
+TILE_INDEX_PREBUILD = env_bool("TILE_INDEX_PREBUILD")
+
+# IP 定位
+GEOIP_DB_PATH = os.environ.get("GEOIP_DB_PATH", "/app/GeoLite2-City.mmdb")
+GEOIP_CACHE_TTL = env_int("GEOIP_CACHE_TTL", 3600)
+GEOIP_CACHE_SIZE = env_int("GEOIP_CACHE_SIZE", 10000)
+
+# 离线瓦片包（.mbtiles / .pmtiles），未命中时是否回源
+OFFLINE_ARCHIVE = os.environ.get("OFFLINE_ARCHIVE", "")
+OFFLINE_UPSTREAM_FALLBACK = env_bool("OFFLINE_UPSTREAM_FALLBACK")
+
+# 预取
+PREFETCH_ENABLED = env_bool("PREFETCH_ENABLED")
+PREFETCH_WORKERS = env_int("PREFETCH_WORKERS", 2)
+PREFETCH_QUEUE_SIZE = env_int("PREFETCH_QUEUE_SIZE", 1000)
+PREFETCH_RING = env_int("PREFETCH_RING", 1)
+PREFETCH_MAX_ZOOM = env_int("PREFETCH_MAX_ZOOM", 18)
+
+# 高德瓦片样式（8 = 道路底图）
+TILE_STYLE = 8
+
+# ===== 监控指标 =====
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    """Prometheus 计数器（按标签值分组）"""
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus 直方图（按标签值分组）"""
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', bound)])} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+TILE_STAGE_SECONDS = Histogram("amap_tile_stage_seconds", "瓦片请求各阶段耗时", ("stage",))
+TILE_RESPONSES = Counter("amap_tile_responses_total", "瓦片响应数（按状态码）", ("status",))
+TILE_SOURCES = Counter("amap_tile_source_total", "瓦片获取来源（memory/disk/offline/upstream/stale/negative/blank/overzoom/underzoom/fallback）", ("source",))
+UPSTREAM_SECONDS = Histogram("amap_upstream_request_seconds", "上游请求耗时（按服务器）", ("host",))
+UPSTREAM_RESPONSES = Counter("amap_upstream_responses_total", "上游响应数（按服务器与状态码，error 为网络错误）", ("host", "status"))
+UPSTREAM_REJECTED = Counter("amap_upstream_rejected_total", "被拒绝的上游响应（short: 内容不足 1000 字节; status: 非 200）", ("reason",))
+GEOIP_SECONDS = Histogram("amap_geoip_lookup_seconds", "GeoIP 查询耗时")
+BATCH_TILES = Counter("amap_batch_tiles_total", "批量接口返回的瓦片数（按状态码）", ("status",))
+METRICS = [TILE_STAGE_SECONDS, TILE_RESPONSES, TILE_SOURCES, UPSTREAM_SECONDS, UPSTREAM_RESPONSES,
+           UPSTREAM_REJECTED, GEOIP_SECONDS, BATCH_TILES]
+
+def render_gauges(prefix, stats):
+    """把各组件 stats() 的数值字段导出为 gauge"""
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    return lines
+
 # ===== 坐标转换函数 =====
 def out_of_china(lng, lat):
     return not (73.66 <= lng <= 135.05 and 3.86 <= lat <= 53.55)
@@ -44,6 +274,103 @@ def wgs84_to_gcj02(lng, lat):
     mglng = lng + dlng
     return mglng, mglat
 
+def _sin_multiples(v):
+    """返回 sin(πv/30)、sin(πv/12)、sin(πv/3)、sin(πv)、sin(2πv)、sin(6πv)
+
+    只算 πv/60 的正弦、余弦，其余由倍角、三倍角、五倍角公式推出，省去大部分三角函数运算。
+    """
+    s60 = np.sin(v * (np.pi / 60.0))
+    c60 = np.cos(v * (np.pi / 60.0))
+    s30 = 2.0 * s60 * c60
+    s60_2 = s60 * s60
+    c60_2 = c60 * c60
+    s12 = s60 * ((16.0 * s60_2 - 20.0) * s60_2 + 5.0)
+    c12 = c60 * ((16.0 * c60_2 - 20.0) * c60_2 + 5.0)
+    s6 = 2.0 * s12 * c12
+    c6 = 1.0 - 2.0 * s12 * s12
+    s3 = 2.0 * s6 * c6
+    c3 = 1.0 - 2.0 * s6 * s6
+    s1 = s3 * (3.0 - 4.0 * s3 * s3)
+    c1 = c3 * (4.0 * c3 * c3 - 3.0)
+    s2 = 2.0 * s1 * c1
+    return s30, s12, s3, s1, s2, s2 * (3.0 - 4.0 * s2 * s2)
+
+def wgs84_to_gcj02_array(lng, lat):
+    """wgs84_to_gcj02 的 NumPy 向量化版本，输入输出为同形状数组"""
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x = lng - 105.0
+    y = lat - 35.0
+    sx30, sx12, sx3, sx1, sx2, sx6 = _sin_multiples(x)
+    sy30, sy12, sy3, sy1, _, _ = _sin_multiples(y)
+    sqrt_abs_x = np.sqrt(np.abs(x))
+    common = (20.0 * sx6 + 20.0 * sx2) * 2.0 / 3.0
+    dlat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * sqrt_abs_x + common
+    dlat += (20.0 * sy1 + 40.0 * sy3) * 2.0 / 3.0
+    dlat += (160.0 * sy12 + 320 * sy30) * 2.0 / 3.0
+    dlng = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * sqrt_abs_x + common
+    dlng += (20.0 * sx1 + 40.0 * sx3) * 2.0 / 3.0
+    dlng += (150.0 * sx12 + 300.0 * sx30) * 2.0 / 3.0
+    radlat = lat / 180.0 * np.pi
+    sin_lat = np.sin(radlat)
+    magic = 1 - 0.00669342162296594323 * sin_lat * sin_lat
+    sqrtmagic = np.sqrt(magic)
+    dlat = (dlat * 180.0) / ((6378245.0 * (1 - 0.00669342162296594323)) / (magic * sqrtmagic) * np.pi)
+    dlng = (dlng * 180.0) / (6378245.0 / sqrtmagic * np.sqrt(1.0 - sin_lat * sin_lat) * np.pi)
+    outside = ~((73.66 <= lng) & (lng <= 135.05) & (3.86 <= lat) & (lat <= 53.55))
+    return np.where(outside, lng, lng + dlng), np.where(outside, lat, lat + dlat)
+
+def gcj02_to_wgs84(lng, lat):
+    """GCJ-02 转 WGS84（迭代求逆，误差小于 1e-9 度）"""
+    if out_of_china(lng, lat):
+        return lng, lat
+    wgs_lng, wgs_lat = lng, lat
+    for _ in range(GCJ_INVERSE_MAX_ITER):
+        test_lng, test_lat = wgs84_to_gcj02(wgs_lng, wgs_lat)
+        d_lng, d_lat = test_lng - lng, test_lat - lat
+        wgs_lng -= d_lng
+        wgs_lat -= d_lat
+        if abs(d_lng) < GCJ_INVERSE_TOLERANCE and abs(d_lat) < GCJ_INVERSE_TOLERANCE:
+            break
+    return wgs_lng, wgs_lat
+
+GCJ_INVERSE_BLOCK = 16384
+
+def gcj02_to_wgs84_array(lng, lat):
+    """gcj02_to_wgs84 的 NumPy 向量化版本
+
+    与逐点版本相同，从 2 * gcj - f(gcj) 开始迭代、每个点单独判断收敛，之后每轮只对尚未收敛的点重新计算；
+    中国范围外的点不参与计算。按 GCJ_INVERSE_BLOCK 个点分块，中间数组留在 CPU 缓存中。
+    """
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    wgs_lng, wgs_lat = lng.copy(), lat.copy()
+    out_lng, out_lat = wgs_lng.reshape(-1), wgs_lat.reshape(-1)
+    flat_lng, flat_lat = lng.reshape(-1), lat.reshape(-1)
+    inside = np.flatnonzero((73.66 <= flat_lng) & (flat_lng <= 135.05) & (3.86 <= flat_lat) & (flat_lat <= 53.55))
+    for start in range(0, inside.size, GCJ_INVERSE_BLOCK):
+        active = inside[start:start + GCJ_INVERSE_BLOCK]
+        target_lng, target_lat = flat_lng[active], flat_lat[active]
+        cur_lng, cur_lat = target_lng.copy(), target_lat.copy()
+        for _ in range(GCJ_INVERSE_MAX_ITER):
+            test_lng, test_lat = wgs84_to_gcj02_array(cur_lng, cur_lat)
+            d_lng, d_lat = test_lng - target_lng, test_lat - target_lat
+            cur_lng -= d_lng
+            cur_lat -= d_lat
+            pending = (np.abs(d_lng) >= GCJ_INVERSE_TOLERANCE) | (np.abs(d_lat) >= GCJ_INVERSE_TOLERANCE)
+            if not pending.all():
+                done = ~pending
+                out_lng[active[done]] = cur_lng[done]
+                out_lat[active[done]] = cur_lat[done]
+                if not pending.any():
+                    break
+                active, target_lng, target_lat = active[pending], target_lng[pending], target_lat[pending]
+                cur_lng, cur_lat = cur_lng[pending], cur_lat[pending]
+        else:
+            out_lng[active] = cur_lng
+            out_lat[active] = cur_lat
+    return wgs_lng, wgs_lat
+
 def tile_to_lnglat(x, y, z):
     n = 2.0 ** z
     lng = x / n * 360.0 - 180.0
@@ -58,8 +385,142 @@ def lnglat_to_tile(lng, lat, z):
     y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
     return x, y
 
+MERCATOR_MAX_LAT = 85.05112878
+
+def bbox_tile_range(bbox, z):
+    """经纬度范围在第 z 级覆盖的瓦片编号范围 (x0, y0, x1, y1)，裁剪到 [0, 2^z - 1]"""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    limit = (1 << z) - 1
+    x0, y0 = lnglat_to_tile(min_lng, min(max_lat, MERCATOR_MAX_LAT), z)
+    x1, y1 = lnglat_to_tile(max_lng, max(min_lat, -MERCATOR_MAX_LAT), z)
+    return max(x0, 0), max(y0, 0), min(x1, limit), min(y1, limit)
+
+def wgs84_tile_to_gcj(z, x, y):
+    """WGS84 瓦片对应的高德（GCJ-02）瓦片编号"""
+    lng, lat = tile_to_lnglat(x, y, z)
+    if out_of_china(lng, lat):
+        # 国外不偏移；直接返回原编号，避免角点经纬度往返时的浮点误差落到相邻瓦片
+        return x, y
+    gcj_lng, gcj_lat = wgs84_to_gcj02(lng, lat)
+    return lnglat_to_tile(gcj_lng, gcj_lat, z)
+
+# ===== 瓦片映射索引 =====
+CHINA_BOUNDS = (73.66, 3.86, 135.05, 53.55)  # 与 out_of_china 一致：min_lng, min_lat, max_lng, max_lat
+
+class TileMappingIndex:
+    """WGS84 瓦片 -> GCJ 瓦片编号的映射索引
+
+    映射只取决于 (z, x, y)。低缩放级别（<= array_max_zoom）为中国范围分配 uint16 数组，
+    每个元素保存 GCJ 编号相对原编号的 x、y 偏移（各加 128 后占高低 8 位），按需填充；
+    更高级别使用有上限的 LRU 备忘表。中国范围外的瓦片映射为自身，无需计算。
+
+    两个偏移打包在同一个元素里一次写入，无锁读取时不会读到只写了一半的映射。
+    """
+    UNSET = 0
+
+    def __init__(self, array_max_zoom, memo_size):
+        self.array_max_zoom = array_max_zoom
+        self.memo_size = memo_size
+        self.arrays = {}
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _bounds(self, z):
+        min_lng, min_lat, max_lng, max_lat = CHINA_BOUNDS
+        x0, y0 = lnglat_to_tile(min_lng, max_lat, z)
+        x1, y1 = lnglat_to_tile(max_lng, min_lat, z)
+        return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+    def _array(self, z):
+        entry = self.arrays.get(z)
+        if entry is None:
+            with self.lock:
+                entry = self.arrays.get(z)
+                if entry is None:
+                    x0, y0, width, height = self._bounds(z)
+                    entry = self.arrays[z] = (x0, y0, width, height, array("H", [self.UNSET]) * (width * height))
+        return entry
+
+    def lookup(self, z, x, y):
+        """返回 (gcj_x, gcj_y)"""
+        if z <= self.array_max_zoom:
+            x0, y0, width, height, deltas = self._array(z)
+            col, row = x - x0, y - y0
+            if not (0 <= col < width and 0 <= row < height):
+                return x, y
+            i = row * width + col
+            packed = deltas[i]
+            if packed != self.UNSET:
+                self.hits += 1
+                return x + (packed >> 8) - 128, y + (packed & 0xFF) - 128
+            self.misses += 1
+            gcj_x, gcj_y = wgs84_tile_to_gcj(z, x, y)
+            if -128 < gcj_x - x < 128 and -128 < gcj_y - y < 128:
+                deltas[i] = (gcj_x - x + 128) << 8 | (gcj_y - y + 128)
+            return gcj_x, gcj_y
+
+        key = (z, x, y)
+        with self.lock:
+            result = self.memo.get(key)
+            if result is not None:
+                self.memo.move_to_end(key)
+                self.hits += 1
+                return result
+        self.misses += 1
+        result = wgs84_tile_to_gcj(z, x, y)
+        with self.lock:
+            self.memo[key] = result
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return result
+
+    def prebuild(self):
+        """预先填满所有数组级别（有 numpy 时向量化计算）"""
+        started = time.time()
+        for z in range(self.array_max_zoom + 1):
+            x0, y0, width, height, deltas = self._array(z)
+            if np is not None:
+                xs, ys = np.meshgrid(np.arange(x0, x0 + width), np.arange(y0, y0 + height))
+                n = 2.0 ** z
+                lng = xs / n * 360.0 - 180.0
+                lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ys / n))))
+                gcj_lng, gcj_lat = wgs84_to_gcj02_array(lng, lat)
+                gx = ((gcj_lng + 180.0) / 360.0 * n).astype(np.int64)
+                gy = ((1.0 - np.arcsinh(np.tan(np.radians(gcj_lat))) / np.pi) / 2.0 * n).astype(np.int64)
+                min_lng, min_lat, max_lng, max_lat = CHINA_BOUNDS
+                inside = (min_lng <= lng) & (lng <= max_lng) & (min_lat <= lat) & (lat <= max_lat)
+                dx = np.where(inside, gx - xs, 0) + 128
+                dy = np.where(inside, gy - ys, 0) + 128
+                deltas[:] = array("H", (dx << 8 | dy).astype(np.uint16).tobytes())
+            else:
+                for row in range(height):
+                    for col in range(width):
+                        self.lookup(z, x0 + col, y0 + row)
+        logger.info(f"瓦片映射索引预构建完成: z<={self.array_max_zoom}, 用时 {time.time() - started:.2f}s")
+
+    def stats(self):
+        return {
+            "array_zooms": sorted(self.arrays),
+            "array_bytes": sum(len(entry[4]) * entry[4].itemsize for entry in self.arrays.values()),
+            "memo_entries": len(self.memo),
+            "memo_size": self.memo_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+tile_index = TileMappingIndex(TILE_INDEX_ARRAY_MAX_ZOOM, TILE_INDEX_MEMO_SIZE)
+if TILE_INDEX_PREBUILD:
+    tile_index.prebuild()
+
 # 高德地图服务器
-AMAP_SERVERS = ["webrd01.is.autonavi.com", "webrd02.is.autonavi.com", "webrd03.is.autonavi.com", "webrd04.is.autonavi.com"]
+# 可通过 AMAP_SERVERS（逗号分隔）与 AMAP_TILE_URL 指向其他上游，例如本地压测桩
+AMAP_SERVERS = [host.strip() for host in os.environ.get(
+    "AMAP_SERVERS", "webrd01.is.autonavi.com,webrd02.is.autonavi.com,webrd03.is.autonavi.com,webrd04.is.autonavi.com"
+).split(",") if host.strip()]
+AMAP_TILE_URL = os.environ.get(
+    "AMAP_TILE_URL", "http://{host}/appmaptile?lang=zh_cn&size=1&scale=1&style={style}&x={x}&y={y}&z={z}")
 
 # 预设城市坐标
 PRESET_LOCATIONS = {
@@ -71,25 +532,58 @@ PRESET_LOCATIONS = {
 }
 
 class LocationService:
-    def __init__(self):
+    def __init__(self, db_path, cache_ttl, cache_size):
+        self.db_path = db_path
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
         self.geoip_reader = None
-        self.init_geoip()
+        self.geoip_loaded = False
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
     
     def init_geoip(self):
-        """初始化IP地理定位数据库"""
+        """初始化IP地理定位数据库（首次使用时调用，以 mmap 方式打开）"""
         try:
-            db_path = "/app/GeoLite2-City.mmdb"
-            if os.path.exists(db_path):
-                self.geoip_reader = geoip2.database.Reader(db_path)
+            if os.path.exists(self.db_path):
+                self.geoip_reader = geoip2.database.Reader(self.db_path, mode=geoip2.database.MODE_MMAP)
                 logger.info("GeoIP数据库加载成功")
             else:
                 logger.warning("未找到GeoIP数据库，将使用备用定位方案")
         except Exception as e:
             logger.error(f"GeoIP数据库加载失败: {e}")
     
+    def get_reader(self):
+        if not self.geoip_loaded:
+            with self.lock:
+                if not self.geoip_loaded:
+                    self.init_geoip()
+                    self.geoip_loaded = True
+        return self.geoip_reader
+    
     def get_location_by_ip(self, ip_address):
-        """通过IP地址获取地理位置"""
-        if not self.geoip_reader:
+        """通过IP地址获取地理位置（按IP缓存 cache_ttl 秒，失败结果同样缓存）"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(ip_address)
+            if cached is not None and cached[0] > now:
+                self.cache.move_to_end(ip_address)
+                self.cache_hits += 1
+                return cached[1]
+            self.cache_misses += 1
+        
+        location = self._lookup(ip_address)
+        with self.lock:
+            self.cache[ip_address] = (now + self.cache_ttl, location)
+            self.cache.move_to_end(ip_address)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return location
+    
+    def _lookup(self, ip_address):
+        reader = self.get_reader()
+        if not reader:
             return None
             
         try:
@@ -98,7 +592,11 @@ class LocationService:
                 logger.info(f"内网IP {ip_address}，跳过IP定位")
                 return None
                 
-            response = self.geoip_reader.city(ip_address)
+            started = time.perf_counter()
+            try:
+                response = reader.city(ip_address)
+            finally:
+                GEOIP_SECONDS.observe(time.perf_counter() - started)
             return {
                 'lng': response.location.longitude,
                 'lat': response.location.latitude,
@@ -110,6 +608,15 @@ class LocationService:
             logger.warning(f"IP定位失败 {ip_address}: {e}")
             return None
     
+    def stats(self):
+        return {
+            "loaded": self.geoip_loaded,
+            "available": self.geoip_reader is not None,
+            "cache_entries": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+    
     def get_default_location(self):
         """获取默认位置"""
         default_loc = PRESET_LOCATIONS['beijing'].copy()
@@ -149,8 +656,2063 @@ class LocationService:
         # 3. 默认位置（保底）
         return self.get_default_location()
 
-# 创建全局定位服务实例
-location_service = LocationService()
+# 创建全局定位服务实例（GeoIP 数据库在首次定位时才加载）
+location_service = LocationService(GEOIP_DB_PATH, GEOIP_CACHE_TTL, GEOIP_CACHE_SIZE)
+
+# ===== 瓦片缓存 =====
+MAX_TILE_ZOOM = 24  # 缓存键中 x、y 各占 24 位
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+def pack_tile_key(key):
+    """把 (style, z, x, y) 打包成 64 位整数，0 保留为空槽；超出范围的编号会互相混淆，直接拒绝"""
+    style, z, x, y = key
+    if not valid_tile(z, x, y):
+        raise ValueError(f"瓦片编号超出范围: {key}")
+    return (1 << 63) | (style << 56) | (z << 48) | (x << 24) | y
+
+def unpack_tile_key(packed):
+    return ((packed >> 56) & 0x7F, (packed >> 48) & 0xFF, (packed >> 24) & 0xFFFFFF, packed & 0xFFFFFF)
+
+class ProcessLock:
+    """线程间 + 进程间（flock）的读写锁，共用同一缓存目录的多个进程之间也互斥
+
+    with lock 为排他锁，with lock.shared() 为共享锁：只读操作可以在多个线程、多个进程间并发。
+    flock 属于打开的文件描述，进程内所有线程共用一个描述，因此进程内先用条件变量协调：
+    第一个读者加 LOCK_SH、最后一个读者解锁，写者等本进程读者全部退出后再加 LOCK_EX；
+    有写者等待时新读者让路，避免写者饿死。
+    fork 后在子进程中重新打开锁文件：继承来的描述与父进程共用同一把锁。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self._open()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._open)
+
+    def _open(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.acquiring = False  # 第一个读者正在加共享 flock
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644) if fcntl else None
+
+    def __enter__(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers or self.acquiring:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        if self.fd is not None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._release_writer()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._release_writer()
+
+    def _release_writer(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        with self.cond:
+            while self.writer or self.waiting_writers or self.acquiring:
+                self.cond.wait()
+            self.readers += 1
+            first = self.readers == 1
+            self.acquiring = first
+        if first:
+            try:
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_SH)
+            except BaseException:
+                with self.cond:
+                    self.readers -= 1
+                    self.acquiring = False
+                    self.cond.notify_all()
+                raise
+            with self.cond:
+                self.acquiring = False
+                self.cond.notify_all()
+        try:
+            yield self
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    if self.fd is not None:
+                        fcntl.flock(self.fd, fcntl.LOCK_UN)
+                    self.cond.notify_all()
+
+class DiskTileCache:
+    """持久化磁盘瓦片缓存
+
+    瓦片文件按 {style}/{z}/{x}/{y}.jpg 存放，原子写入（临时文件 + rename）。
+    索引是 mmap 映射的开放寻址哈希表（线性探测、删除时后移），重启后直接映射，
+    无需扫描目录。超出字节预算时随机采样淘汰最久未访问的条目（近似 LRU），
+    超过 TTL 的条目视为未命中并优先淘汰。索引读写持有文件锁（查找用共享锁，只更新
+    访问时间字段；写入、删除用排他锁），多个工作进程（以及 seed/export 命令）可以共用同一缓存目录。
+    """
+    MAGIC = b"AMTC"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIIIQ")   # magic, version, capacity, count, total_bytes
+    SLOT = struct.Struct("<QIII")       # key, size, mtime, atime
+    ATIME = struct.Struct("<I")
+    ATIME_OFFSET = 16                   # atime 在槽位中的偏移，持共享锁时只写这 4 字节
+    MAX_LOAD = 0.7
+    EVICT_SAMPLES = 16
+    AVG_TILE_BYTES = 16 * 1024
+
+    def __init__(self, root, max_bytes, ttl=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        wanted = max(1024, int(max_bytes / self.AVG_TILE_BYTES / self.MAX_LOAD))
+        self.capacity = 1 << (wanted - 1).bit_length()
+        os.makedirs(os.path.join(root, "tiles"), exist_ok=True)
+        self.index_path = os.path.join(root, "index.bin")
+        self.lock = ProcessLock(os.path.join(root, "index.lock"))
+        with self.lock:
+            resized = self._open_index()
+        if resized:
+            self._unlink(self._evict())
+        atexit.register(self.close)
+
+    # --- 索引文件 ---
+    def _open_index(self):
+        """映射索引文件，容量变化时重建；返回是否重建了已有索引（调用方持有锁）"""
+        size = self.HEADER.size + self.capacity * self.SLOT.size
+        existing = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                head = f.read(self.HEADER.size)
+            if len(head) == self.HEADER.size:
+                magic, version, capacity, _, _ = self.HEADER.unpack(head)
+                if magic == self.MAGIC and version == self.VERSION:
+                    existing = capacity
+
+        if existing == self.capacity:
+            fd = os.open(self.index_path, os.O_RDWR)
+            self._mm = mmap.mmap(fd, size)
+            os.close(fd)
+            logger.info(f"磁盘缓存索引已加载: {self.count} 个瓦片, {self.total_bytes} 字节")
+            return False
+
+        old_entries = self._read_entries(self.index_path, existing) if existing else []
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+        fd = os.open(tmp_path, os.O_RDWR)
+        mm = mmap.mmap(fd, size)
+        os.close(fd)
+        self.HEADER.pack_into(mm, 0, self.MAGIC, self.VERSION, self.capacity, 0, 0)
+        self._mm = mm
+        for packed, fsize, mtime, atime in old_entries:
+            if self.count < self.capacity * self.MAX_LOAD:
+                self._insert(packed, fsize, mtime, atime)
+        mm.flush()
+        os.replace(tmp_path, self.index_path)
+
+        if existing:
+            logger.info(f"磁盘缓存索引已按新容量重建: {self.count} 个瓦片")
+            return True
+        if any(os.scandir(os.path.join(self.root, "tiles"))):
+            # 索引丢失但目录中已有瓦片：后台收编，不阻塞启动
+            threading.Thread(target=self._adopt_orphans, daemon=True).start()
+        return False
+
+    def _read_entries(self, path, capacity):
+        entries = []
+        with open(path, "rb") as f:
+            f.seek(self.HEADER.size)
+            for _ in range(capacity):
+                slot = self.SLOT.unpack(f.read(self.SLOT.size))
+                if slot[0]:
+                    entries.append(slot)
+        return entries
+
+    def _adopt_orphans(self):
+        """后台扫描已有瓦片文件并写入索引"""
+        adopted = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, "tiles")):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not name.endswith(".jpg"):
+                    continue
+                try:
+                    parts = os.path.relpath(path, os.path.join(self.root, "tiles")).split(os.sep)
+                    key = (int(parts[0]), int(parts[1]), int(parts[2]), int(parts[3][:-4]))
+                    st = os.stat(path)
+                except (ValueError, IndexError, OSError):
+                    continue
+                if not valid_tile(*key[1:]):
+                    continue
+                with self.lock:
+                    if self._find(pack_tile_key(key)) < 0:
+                        self._store(pack_tile_key(key), st.st_size, int(st.st_mtime))
+                        adopted += 1
+                evicted = self._evict()
+                self._unlink(evicted)
+        logger.info(f"磁盘缓存已收编 {adopted} 个未索引瓦片")
+
+    def close(self):
+        try:
+            self._mm.flush()
+        except (ValueError, OSError):
+            pass
+
+    # --- 头部字段 ---
+    @property
+    def count(self):
+        return self.HEADER.unpack_from(self._mm, 0)[3]
+
+    @property
+    def total_bytes(self):
+        return self.HEADER.unpack_from(self._mm, 0)[4]
+
+    def _set_totals(self, count, total_bytes):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.VERSION, self.capacity, count, total_bytes)
+
+    # --- 哈希表操作（调用方持有锁） ---
+    def _home(self, packed):
+        return ((packed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self.capacity.bit_length() + 1)
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.SLOT.size
+
+    def _find(self, packed):
+        mask = self.capacity - 1
+        i = self._home(packed)
+        while True:
+            k = struct.unpack_from("<Q", self._mm, self._offset(i))[0]
+            if k == packed:
+                return i
+            if k == 0:
+                return -1
+            i = (i + 1) & mask
+
+    def _insert(self, packed, size, mtime, atime):
+        mask = self.capacity - 1
+        i = self._home(packed)
+        while struct.unpack_from("<Q", self._mm, self._offset(i))[0] != 0:
+            i = (i + 1) & mask
+        self.SLOT.pack_into(self._mm, self._offset(i), packed, size, mtime, atime)
+        self._set_totals(self.count + 1, self.total_bytes + size)
+
+    def _store(self, packed, size, mtime):
+        slot = self._find(packed)
+        if slot >= 0:
+            old_size = self.SLOT.unpack_from(self._mm, self._offset(slot))[1]
+            self.SLOT.pack_into(self._mm, self._offset(slot), packed, size, mtime, mtime)
+            self._set_totals(self.count, self.total_bytes - old_size + size)
+        else:
+            self._insert(packed, size, mtime, mtime)
+
+    def _delete(self, slot):
+        """删除槽位并把后续探测链上的条目前移，保证不留墓碑"""
+        mask = self.capacity - 1
+        size = self.SLOT.unpack_from(self._mm, self._offset(slot))[1]
+        i = j = slot
+        while True:
+            j = (j + 1) & mask
+            entry = self.SLOT.unpack_from(self._mm, self._offset(j))
+            if entry[0] == 0:
+                break
+            home = self._home(entry[0])
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                self.SLOT.pack_into(self._mm, self._offset(i), *entry)
+                i = j
+        self.SLOT.pack_into(self._mm, self._offset(i), 0, 0, 0, 0)
+        self._set_totals(self.count - 1, self.total_bytes - size)
+
+    def _expired(self, mtime, now):
+        return self.ttl > 0 and now - mtime > self.ttl
+
+    def _evict(self):
+        """淘汰到预算以内，返回待删除的文件路径"""
+        victims = []
+        with self.lock:
+            now = int(time.time())
+            while self.count and (self.total_bytes > self.max_bytes or self.count > self.capacity * self.MAX_LOAD):
+                i = random.randrange(self.capacity)
+                best = best_rank = None
+                seen = 0
+                while seen < self.EVICT_SAMPLES and seen < self.count:
+                    packed, _, mtime, atime = self.SLOT.unpack_from(self._mm, self._offset(i))
+                    if packed:
+                        seen += 1
+                        rank = -1 if self._expired(mtime, now) else atime
+                        if best is None or rank < best_rank:
+                            best, best_rank = i, rank
+                    i = (i + 1) & (self.capacity - 1)
+                victims.append(self._path(unpack_tile_key(self.SLOT.unpack_from(self._mm, self._offset(best))[0])))
+                self._delete(best)
+                self.evictions += 1
+        return victims
+
+    def _unlink(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # --- 对外接口 ---
+    def _path(self, key):
+        style, z, x, y = key
+        return os.path.join(self.root, "tiles", str(style), str(z), str(x), f"{y}.jpg")
+
+    def get(self, key):
+        """读取未过期的瓦片，未命中返回 None"""
+        packed = pack_tile_key(key)
+        now = int(time.time())
+        with self.lock.shared():
+            slot = self._find(packed)
+            if slot >= 0:
+                mtime = self.SLOT.unpack_from(self._mm, self._offset(slot))[2]
+                if not self._expired(mtime, now):
+                    self.ATIME.pack_into(self._mm, self._offset(slot) + self.ATIME_OFFSET, now)
+                else:
+                    slot = -1
+        if slot < 0:
+            self.misses += 1
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self.lock:
+                slot = self._find(packed)
+                if slot >= 0:
+                    self._delete(slot)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def get_stale(self, key):
+        """读取已过期的瓦片用于回源验证，返回 (data, mtime)，不存在时返回 None"""
+        with self.lock.shared():
+            slot = self._find(pack_tile_key(key))
+            if slot < 0:
+                return None
+            mtime = self.SLOT.unpack_from(self._mm, self._offset(slot))[2]
+        data = self.read(key)
+        return (data, mtime) if data is not None else None
+
+    def touch(self, key):
+        """上游确认未修改时刷新有效期"""
+        now = int(time.time())
+        with self.lock:
+            slot = self._find(pack_tile_key(key))
+            if slot >= 0:
+                packed, size, _, _ = self.SLOT.unpack_from(self._mm, self._offset(slot))
+                self.SLOT.pack_into(self._mm, self._offset(slot), packed, size, now, now)
+
+    def keys(self):
+        """索引中全部瓦片键（含已过期）"""
+        with self.lock.shared():
+            packed_keys = [self.SLOT.unpack_from(self._mm, self._offset(i))[0] for i in range(self.capacity)]
+        return [unpack_tile_key(packed) for packed in packed_keys if packed]
+
+    def read(self, key):
+        """直接读取瓦片文件，不检查有效期、不计入命中统计"""
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def contains(self, key):
+        """是否有未过期的缓存（只查索引，不读文件）"""
+        with self.lock.shared():
+            slot = self._find(pack_tile_key(key))
+            if slot < 0:
+                return False
+            mtime = self.SLOT.unpack_from(self._mm, self._offset(slot))[2]
+            return not self._expired(mtime, int(time.time()))
+
+    def put(self, key, data):
+        """原子写入瓦片文件并更新索引"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._store(pack_tile_key(key), len(data), int(time.time()))
+            self.writes += 1
+        self._unlink(self._evict())
+
+    def stats(self):
+        return {
+            "entries": self.count,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+class MemoryTileCache:
+    """进程内按总字节数限制的 LRU 瓦片缓存，条目超过 ttl 秒后失效"""
+    def __init__(self, max_bytes, ttl=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, expires = entry
+            if expires and expires < time.monotonic():
+                del self.entries[key]
+                self.bytes -= len(data)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self.entries[key] = (data, expires)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class BlankTile(bytes):
+    """按内容去重的空白瓦片，引用同一内容的所有键共用一个对象，不写入磁盘缓存"""
+
+class FallbackTile(bytes):
+    """上游没有可用瓦片时临时合成的补位瓦片，以及由它派生的瓦片，不写入任何缓存"""
+
+class NegativeTileCache:
+    """上游没有有效瓦片的键（LRU，按条目数限制）
+
+    条目为 (过期时间, 空白瓦片或 None)：None 表示上游返回 404、无效内容或错误，直接按 404 处理、不再回源；
+    空白瓦片按内容哈希去重，只保存一份。
+    """
+    MAX_BLANKS = 1024
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.blanks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.blank_hits = 0
+
+    def get(self, key):
+        """返回 (是否命中, 空白瓦片或 None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expires, blank = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            if blank is None:
+                self.hits += 1
+            else:
+                self.blank_hits += 1
+            return True, blank
+
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def put(self, key, ttl, blank=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, blank)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def intern(self, content):
+        """返回内容相同的共用空白瓦片对象，不同内容过多时返回 None"""
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        with self.lock:
+            blank = self.blanks.get(digest)
+            if blank is None and len(self.blanks) < self.MAX_BLANKS:
+                blank = self.blanks[digest] = BlankTile(content)
+            return blank
+
+    def put_blank(self, key, content):
+        """把内容登记为空白瓦片并返回共用对象，去重表已满时返回 None"""
+        blank = self.intern(content)
+        if blank is not None:
+            self.put(key, CACHE_TTL or NEGATIVE_CACHE_TTL, blank)
+        return blank
+
+    def stats(self):
+        with self.lock:
+            blanks = sum(1 for _, blank in self.entries.values() if blank is not None)
+            return {
+                "entries": len(self.entries),
+                "negative_entries": len(self.entries) - blanks,
+                "blank_entries": blanks,
+                "blank_payloads": len(self.blanks),
+                "blank_bytes": sum(len(blank) for blank in self.blanks.values()),
+                "hits": self.hits,
+                "blank_hits": self.blank_hits,
+            }
+
+class SingleFlight:
+    """合并同一键的并发调用：只有第一个调用者真正执行，其余等待并共享结果"""
+    class _Call:
+        __slots__ = ("event", "result", "error")
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self._Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {"in_flight": len(self.calls), "executed": self.executed, "coalesced": self.coalesced}
+
+class TileFetchLocks:
+    """跨进程的回源互斥
+
+    按键哈希到 stripes 个锁文件之一（flock）。多个工作进程同时未命中同一瓦片时只有一个回源，
+    其余等锁后直接读磁盘缓存。同一进程内同一条带共用一个文件描述并按引用计数释放，进程内不同瓦片
+    不会互相等待（同一瓦片已由 SingleFlight 合并）。加锁只用非阻塞 flock 加轮询，等待期间不会有线程
+    阻塞在 flock 里，异步服务可以直接在事件循环中等待。
+    """
+    POLL_MIN = 0.005
+    POLL_MAX = 0.05
+
+    def __init__(self, root, stripes):
+        self.root = os.path.join(root, "locks")
+        self.stripes = stripes
+        self.lock = threading.Lock()
+        self.held = {}  # 条带 -> [fd, 本进程持有数]
+        self.acquired = 0
+        self.waited = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def stripe(self, key):
+        return (((pack_tile_key(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % self.stripes
+
+    def try_acquire(self, stripe):
+        """不阻塞地加锁；条带被其他进程持有时返回 False"""
+        with self.lock:
+            entry = self.held.get(stripe)
+            if entry is None:
+                fd = os.open(os.path.join(self.root, f"{stripe}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    return False
+                except BaseException:
+                    os.close(fd)
+                    raise
+                entry = self.held[stripe] = [fd, 0]
+            entry[1] += 1
+            self.acquired += 1
+            return True
+
+    def acquire(self, key):
+        """加锁（轮询等待），返回 (条带, 是否等待过)"""
+        stripe = self.stripe(key)
+        delay = self.POLL_MIN
+        waited = False
+        while not self.try_acquire(stripe):
+            waited = True
+            time.sleep(delay)
+            delay = min(delay * 2, self.POLL_MAX)
+        self.waited += waited
+        return stripe, waited
+
+    async def acquire_async(self, key):
+        """acquire 的异步版本，在事件循环中轮询"""
+        stripe = self.stripe(key)
+        delay = self.POLL_MIN
+        waited = False
+        while not self.try_acquire(stripe):
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.POLL_MAX)
+        self.waited += waited
+        return stripe, waited
+
+    def release(self, stripe):
+        with self.lock:
+            entry = self.held[stripe]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.held[stripe]
+                # 关闭描述符即释放 flock
+                os.close(entry[0])
+
+    def stats(self):
+        return {"acquired": self.acquired, "waited": self.waited, "held": len(self.held)}
+
+# 磁盘缓存实例（CACHE_ENABLED=true 时启用）
+tile_cache = DiskTileCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL) if CACHE_ENABLED else None
+memory_cache = MemoryTileCache(MEMORY_CACHE_BYTES, CACHE_TTL) if MEMORY_CACHE_BYTES > 0 else None
+negative_cache = NegativeTileCache(NEGATIVE_CACHE_SIZE) if NEGATIVE_CACHE_SIZE > 0 else None
+tile_flight = SingleFlight()
+# 多进程模式下由 init_worker 创建
+fetch_locks = None
+# 当前线程是否在做后台（预取）获取
+fetch_context = threading.local()
+
+# ===== 离线瓦片包 =====
+# 瓦片包保存的是高德原始瓦片，编号为 GCJ-02 瓦片编号（与缓存键一致）
+def detect_tile_format(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+def archive_metadata(keys, tile_format):
+    """根据瓦片编号计算缩放级别与经纬度范围（GCJ-02）"""
+    min_zoom = min(z for z, _, _ in keys)
+    max_zoom = max(z for z, _, _ in keys)
+    top = [(x, y) for z, x, y in keys if z == max_zoom]
+    west, north = tile_to_lnglat(min(x for x, _ in top), min(y for _, y in top), max_zoom)
+    east, south = tile_to_lnglat(max(x for x, _ in top) + 1, max(y for _, y in top) + 1, max_zoom)
+    return {
+        "name": "amap-tile-proxy",
+        "format": tile_format,
+        "type": "baselayer",
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": [round(west, 6), round(south, 6), round(east, 6), round(north, 6)],
+        "description": "高德地图瓦片，GCJ-02 坐标系瓦片编号",
+        "attribution": "© 高德地图",
+    }
+
+class MBTilesArchive:
+    """只读 MBTiles 瓦片包：每个线程一个常驻连接，SQLite 以 mmap 方式读取"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.conn()
+
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={os.path.getsize(self.path)}")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        _, z, x, y = key
+        row = self.conn().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (z, x, (1 << z) - 1 - y)).fetchone()
+        return bytes(row[0]) if row else None
+
+    @staticmethod
+    def write(path, tiles, metadata):
+        """tiles 为 ((z, x, y), data) 的可迭代对象"""
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        """)
+        conn.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            (name, ",".join(map(str, value)) if isinstance(value, list) else str(value))
+            for name, value in metadata.items()
+        ])
+        conn.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                         ((z, x, (1 << z) - 1 - y, data) for (z, x, y), data in tiles))
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, path)
+
+def pmtiles_tile_id(z, x, y):
+    """PMTiles v3 瓦片 ID：低缩放级别瓦片总数 + Hilbert 曲线序号"""
+    acc = ((1 << (z * 2)) - 1) // 3
+    a = z - 1
+    s = 1 << a if z > 0 else 0
+    while s > 0:
+        rx = s & x
+        ry = s & y
+        acc += ((3 * rx) ^ ry) << a
+        if ry == 0:
+            if rx != 0:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+        a -= 1
+    return acc
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+class PMTilesArchive:
+    """只读 PMTiles v3 瓦片包
+
+    文件以 mmap 映射，打开时把根目录与叶目录展开成 tile_id -> (offset, length) 字典，
+    之后每次查询都是 O(1) 的字典查找加内存切片，不再打开文件。
+    """
+    HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+    TILE_TYPES = {"png": 2, "jpg": 3, "webp": 4, "avif": 5}
+    COMPRESSION_NONE = 1
+    COMPRESSION_GZIP = 2
+    ROOT_MAX_BYTES = 16384 - 127
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.HEADER.unpack_from(self._mm, 0)
+        if header[0] != b"PMTiles" or header[1] != 3:
+            raise ValueError(f"不是 PMTiles v3 文件: {path}")
+        (_, _, root_offset, root_length, _, _, leaf_offset, _, self.tile_data_offset,
+         _, _, _, _, _, self.internal_compression) = header[:15]
+        self.offsets = {}
+        self._load_directory(root_offset, root_length, leaf_offset)
+
+    def _decompress(self, data):
+        return gzip.decompress(data) if self.internal_compression == self.COMPRESSION_GZIP else data
+
+    def _load_directory(self, offset, length, leaf_offset):
+        buf = self._decompress(self._mm[offset:offset + length])
+        count, pos = _read_varint(buf, 0)
+        tile_ids, run_lengths, lengths = [], [], []
+        last_id = 0
+        for _ in range(count):
+            delta, pos = _read_varint(buf, pos)
+            last_id += delta
+            tile_ids.append(last_id)
+        for _ in range(count):
+            value, pos = _read_varint(buf, pos)
+            run_lengths.append(value)
+        for _ in range(count):
+            value, pos = _read_varint(buf, pos)
+            lengths.append(value)
+        entry_offset = 0
+        for i in range(count):
+            value, pos = _read_varint(buf, pos)
+            entry_offset = entry_offset + lengths[i - 1] if value == 0 and i > 0 else value - 1
+            if run_lengths[i] == 0:
+                self._load_directory(leaf_offset + entry_offset, lengths[i], leaf_offset)
+            else:
+                for tile_id in range(tile_ids[i], tile_ids[i] + run_lengths[i]):
+                    self.offsets[tile_id] = (entry_offset, lengths[i])
+
+    def get(self, key):
+        _, z, x, y = key
+        entry = self.offsets.get(pmtiles_tile_id(z, x, y))
+        if entry is None:
+            return None
+        start = self.tile_data_offset + entry[0]
+        return self._mm[start:start + entry[1]]
+
+    @staticmethod
+    def _encode_directory(entries):
+        out = bytearray()
+        _write_varint(out, len(entries))
+        last_id = 0
+        for tile_id, _, _, _ in entries:
+            _write_varint(out, tile_id - last_id)
+            last_id = tile_id
+        for entry in entries:
+            _write_varint(out, entry[3])
+        for entry in entries:
+            _write_varint(out, entry[2])
+        for i, (_, offset, _, _) in enumerate(entries):
+            prev = entries[i - 1] if i else None
+            _write_varint(out, 0 if prev and offset == prev[1] + prev[2] else offset + 1)
+        return gzip.compress(bytes(out), compresslevel=6)
+
+    @classmethod
+    def _build_directories(cls, entries):
+        root = cls._encode_directory(entries)
+        if len(root) <= cls.ROOT_MAX_BYTES:
+            return root, b""
+        leaf_size = 4096
+        while True:
+            leaves = bytearray()
+            root_entries = []
+            for start in range(0, len(entries), leaf_size):
+                chunk = entries[start:start + leaf_size]
+                leaf = cls._encode_directory(chunk)
+                root_entries.append((chunk[0][0], len(leaves), len(leaf), 0))
+                leaves += leaf
+            root = cls._encode_directory(root_entries)
+            if len(root) <= cls.ROOT_MAX_BYTES:
+                return root, bytes(leaves)
+            leaf_size *= 2
+
+    @classmethod
+    def write(cls, path, tiles, metadata):
+        """tiles 为按 tile_id 升序的 ((z, x, y), data) 可迭代对象；相同内容只存一份，相邻相同瓦片合并为游程"""
+        tmp_path = path + ".tmp"
+        data_path = path + ".data.tmp"
+        entries = []      # [tile_id, offset, length, run_length]
+        contents = {}
+        addressed = 0
+        data_length = 0
+        with open(data_path, "wb") as data_file:
+            for (z, x, y), data in tiles:
+                tile_id = pmtiles_tile_id(z, x, y)
+                if entries and tile_id < entries[-1][0]:
+                    raise ValueError("PMTiles 写入要求瓦片按 tile_id 升序")
+                digest = hashlib.blake2b(data, digest_size=16).digest()
+                addressed += 1
+                prev = entries[-1] if entries else None
+                if prev and contents.get(digest) == prev[1] and tile_id == prev[0] + prev[3]:
+                    prev[3] += 1
+                    continue
+                offset = contents.get(digest)
+                if offset is None:
+                    offset = contents[digest] = data_length
+                    data_file.write(data)
+                    data_length += len(data)
+                entries.append([tile_id, offset, len(data), 1])
+
+        root, leaves = cls._build_directories([tuple(e) for e in entries])
+        meta = gzip.compress(json.dumps(metadata, ensure_ascii=False).encode())
+        root_offset = cls.HEADER.size
+        meta_offset = root_offset + len(root)
+        leaf_offset = meta_offset + len(meta)
+        tile_offset = leaf_offset + len(leaves)
+        west, south, east, north = metadata["bounds"]
+        header = cls.HEADER.pack(
+            b"PMTiles", 3, root_offset, len(root), meta_offset, len(meta), leaf_offset, len(leaves),
+            tile_offset, data_length, addressed, len(entries), len(contents),
+            1, cls.COMPRESSION_GZIP, cls.COMPRESSION_NONE, cls.TILE_TYPES.get(metadata["format"], 0),
+            metadata["minzoom"], metadata["maxzoom"],
+            int(west * 1e7), int(south * 1e7), int(east * 1e7), int(north * 1e7),
+            metadata["minzoom"], int((west + east) / 2 * 1e7), int((south + north) / 2 * 1e7))
+        with open(tmp_path, "wb") as out:
+            out.write(header + root + meta + leaves)
+            with open(data_path, "rb") as data_file:
+                shutil.copyfileobj(data_file, out, 1024 * 1024)
+        os.remove(data_path)
+        os.replace(tmp_path, path)
+
+def open_archive(path):
+    return PMTilesArchive(path) if path.endswith(".pmtiles") else MBTilesArchive(path)
+
+def export_archive(path, zooms=None):
+    """把磁盘缓存中的高德瓦片导出为 .mbtiles 或 .pmtiles"""
+    keys = [(z, x, y) for style, z, x, y in tile_cache.keys()
+            if style == TILE_STYLE and (zooms is None or z in zooms)]
+    if not keys:
+        raise ValueError("磁盘缓存中没有可导出的瓦片")
+
+    def read_tiles(selected):
+        for z, x, y in selected:
+            data = tile_cache.read((TILE_STYLE, z, x, y))
+            if data is not None:
+                yield (z, x, y), data
+
+    if path.endswith(".pmtiles"):
+        keys.sort(key=lambda k: pmtiles_tile_id(*k))
+    first = next(read_tiles(keys), None)
+    metadata = archive_metadata(keys, detect_tile_format(first[1]) if first else "jpg")
+    writer = PMTilesArchive if path.endswith(".pmtiles") else MBTilesArchive
+    writer.write(path, read_tiles(keys), metadata)
+    logger.info(f"已导出 {len(keys)} 个瓦片到 {path}")
+    return len(keys)
+
+offline_archive = open_archive(OFFLINE_ARCHIVE) if OFFLINE_ARCHIVE else None
+
+# ===== 瓦片获取 =====
+UPSTREAM_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "Referer": "https://www.amap.com/"
+}
+
+class HostHealth:
+    """单个上游服务器的滚动延迟、错误率与熔断器
+
+    连续失败达到阈值或窗口内错误率超过一半时熔断（open），冷却后放行一个试探请求
+    （half_open），试探成功则恢复（closed），失败则继续熔断。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    MIN_SAMPLES = 10
+
+    def __init__(self, window, failure_threshold, cooldown):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """是否允许向该服务器发请求（half_open 时只放行一个试探请求）"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.requests += 1
+            self.outcomes.append(ok)
+            self.trial_in_flight = False
+            if ok:
+                self.latencies.append(latency)
+                self.consecutive_failures = 0
+                if self.state != self.CLOSED:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                return
+            self.failures += 1
+            self.consecutive_failures += 1
+            if (self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold
+                    or (len(self.outcomes) >= self.MIN_SAMPLES and self.error_rate() > 0.5)):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, q):
+        if len(self.latencies) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def score(self):
+        """越小越好：中位延迟按错误率加权"""
+        return (self.percentile(0.5) or 0.0) * (1 + 10 * self.error_rate())
+
+    def snapshot(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate(), 4),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+class UpstreamOverloaded(requests.exceptions.RequestException):
+    """上游并发已满，排队超时或被拒绝"""
+
+class AdmissionWaiter:
+    __slots__ = ("host", "wake", "granted", "rejected")
+
+    def __init__(self, host, wake):
+        self.host = host
+        self.wake = wake
+        self.granted = False
+        self.rejected = False
+
+class AdmissionController:
+    """上游准入控制
+
+    限制全局与单服务器的并发请求数。没有空位时进入有界等待队列，前台请求排在后台预取之前，
+    释放名额时直接交给可运行的第一个等待者。队列已满（前台请求会先挤掉最新的后台请求）
+    或等待超过期限时抛出 UpstreamOverloaded，调用方返回 503 或过期缓存，不阻塞工作线程。
+    同步线程与异步事件循环共用同一组名额。
+    """
+    def __init__(self, servers, max_total, max_per_host, queue_size, timeout):
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.host_active = {host: 0 for host in servers}
+        self.queues = (deque(), deque())  # 前台、后台
+        self.admitted = 0
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.shed_preempted = 0
+
+    def _has_room(self, host):
+        return self.active < self.max_total and self.host_active[host] < self.max_per_host
+
+    def _take(self, host):
+        self.active += 1
+        self.host_active[host] += 1
+        self.admitted += 1
+
+    def try_acquire(self, host):
+        """有空位时占用并返回 True，不排队"""
+        with self.lock:
+            if self._has_room(host):
+                self._take(host)
+                return True
+            return False
+
+    def _enqueue(self, host, background, wake):
+        """有空位时直接占用并返回 None，否则排队并返回等待者"""
+        victim = None
+        with self.lock:
+            if self._has_room(host):
+                self._take(host)
+                return None
+            if len(self.queues[0]) + len(self.queues[1]) >= self.queue_size:
+                if background or not self.queues[1]:
+                    self.shed_queue_full += 1
+                    raise UpstreamOverloaded(f"上游排队已满: {host}")
+                victim = self.queues[1].pop()
+                victim.rejected = True
+                self.shed_preempted += 1
+            waiter = AdmissionWaiter(host, wake)
+            self.queues[1 if background else 0].append(waiter)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queues[0]) + len(self.queues[1]))
+        if victim:
+            victim.wake()
+        return waiter
+
+    def _finish_wait(self, waiter):
+        """等待结束（被唤醒或超时）后确认是否拿到名额"""
+        with self.lock:
+            if waiter.granted:
+                return
+            if not waiter.rejected:
+                for queue in self.queues:
+                    if waiter in queue:
+                        queue.remove(waiter)
+                self.shed_timeout += 1
+        if waiter.rejected:
+            raise UpstreamOverloaded(f"上游繁忙，后台请求让位给前台请求: {waiter.host}")
+        raise UpstreamOverloaded(f"上游排队超时: {waiter.host}")
+
+    def acquire(self, host, background=False):
+        """占用一个名额，必要时排队等待，失败时抛出 UpstreamOverloaded"""
+        event = threading.Event()
+        waiter = self._enqueue(host, background, event.set)
+        if waiter is not None:
+            event.wait(self.timeout)
+            self._finish_wait(waiter)
+
+    async def acquire_async(self, host, background=False):
+        """acquire 的异步版本"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(host, background, wake)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self.lock:
+                for queue in self.queues:
+                    if waiter in queue:
+                        queue.remove(waiter)
+            if waiter.granted:
+                self.release(host)
+            raise
+        self._finish_wait(waiter)
+
+    def release(self, host):
+        woken = []
+        with self.lock:
+            self.active -= 1
+            self.host_active[host] -= 1
+            for queue in self.queues:
+                if self.active >= self.max_total:
+                    break
+                for waiter in list(queue):
+                    if self._has_room(waiter.host):
+                        queue.remove(waiter)
+                        self._take(waiter.host)
+                        waiter.granted = True
+                        woken.append(waiter)
+        for waiter in woken:
+            waiter.wake()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": self.active,
+                "queue_depth": len(self.queues[0]) + len(self.queues[1]),
+                "queue_depth_background": len(self.queues[1]),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed_queue_full": self.shed_queue_full,
+                "shed_timeout": self.shed_timeout,
+                "shed_preempted": self.shed_preempted,
+                "host_active": dict(self.host_active),
+            }
+
+class UpstreamClient:
+    """高德上游客户端
+
+    每个 webrd 服务器一个 keep-alive 连接池，并跟踪各服务器的健康状况：
+    默认按 (x + y) 哈希选服务器，熔断的服务器被跳过；主请求超过该服务器
+    p95 延迟仍未返回时，向另一台健康服务器发送对冲请求，取先成功的结果。
+    每个请求先经过准入控制占用并发名额，对冲请求只在有空位时发出。
+    """
+    def __init__(self, servers, pool_size, connect_timeout, read_timeout, retries, backoff, workers=1):
+        self.servers = servers
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapters = {}
+        self.sessions = {}
+        self.health = {host: HostHealth(UPSTREAM_HEALTH_WINDOW, UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_COOLDOWN)
+                       for host in servers}
+        self.hedge_enabled = UPSTREAM_HEDGE and len(servers) > 1
+        self.executor = ThreadPoolExecutor(max_workers=UPSTREAM_HEDGE_WORKERS, thread_name_prefix="upstream") \
+            if self.hedge_enabled else None
+        self.hedged = 0
+        self.hedge_wins = 0
+        # 每个服务器的请求速率限制（预热时使用），在请求真正发出时按实际服务器生效，对冲请求同样计入
+        self.rate_limiters = {}
+        # 多进程部署时并发上限与队列长度按进程数均分，所有进程合计不超过配置值
+        share = lambda limit: max(1, limit // workers)
+        self.admission = AdmissionController(servers, share(UPSTREAM_MAX_CONCURRENCY), share(UPSTREAM_HOST_CONCURRENCY),
+                                             share(UPSTREAM_QUEUE_SIZE), UPSTREAM_QUEUE_TIMEOUT)
+        for host in servers:
+            # 只对幂等的 GET 重试，连接错误与 429/5xx 按指数退避
+            retry = Retry(total=retries, backoff_factor=backoff,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset(["GET"]), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.headers.update(UPSTREAM_HEADERS)
+            session.mount(f"http://{host}/", adapter)
+            self.adapters[host] = adapter
+            self.sessions[host] = session
+
+    def select_host(self, x, y):
+        return self.servers[(x + y) % len(self.servers)]
+
+    def tile_url(self, host, style, z, x, y):
+        return AMAP_TILE_URL.format(host=host, style=style, z=z, x=x, y=y)
+
+    def get(self, host, url, headers=None):
+        return self.sessions[host].get(url, headers=headers, timeout=self.timeout)
+
+    def ranked_hosts(self, x, y):
+        """哈希选中的服务器在前，其余按延迟与错误率排序；哈希服务器明显变慢时整体按得分排序"""
+        primary = self.select_host(x, y)
+        ranked = [primary] + sorted((h for h in self.servers if h != primary), key=lambda h: self.health[h].score())
+        if len(ranked) > 1:
+            best_score = self.health[ranked[1]].score()
+            if best_score and self.health[primary].score() > UPSTREAM_SLOW_FACTOR * best_score:
+                ranked.sort(key=lambda h: self.health[h].score())
+        return ranked
+
+    def pick(self, ranked, exclude=()):
+        """选出第一个熔断器放行的服务器，没有则返回 None"""
+        for host in ranked:
+            if host not in exclude and self.health[host].allow():
+                return host
+        return None
+
+    def hedge_deadline(self, host):
+        """对冲等待时间：请求所发往服务器自身的 p95 延迟，限制在 [MIN, MAX] 内，只有约 5% 的请求会被对冲"""
+        p95 = self.health[host].percentile(0.95)
+        if p95 is None:
+            return UPSTREAM_HEDGE_MAX_DELAY
+        return min(max(p95, UPSTREAM_HEDGE_MIN_DELAY), UPSTREAM_HEDGE_MAX_DELAY)
+
+    def record(self, host, started, status_code=None):
+        """记录一次请求结果；status_code 为 None 表示网络错误"""
+        ok = status_code is not None and status_code < 500 and status_code != 429
+        elapsed = time.monotonic() - started
+        self.health[host].record(elapsed, ok)
+        UPSTREAM_SECONDS.observe(elapsed, host)
+        UPSTREAM_RESPONSES.inc(host, str(status_code) if status_code is not None else "error")
+
+    def _timed_get(self, host, style, z, x, y, headers):
+        """发出请求（调用方已占用准入名额，这里负责释放）"""
+        url = self.tile_url(host, style, z, x, y)
+        limiter = self.rate_limiters.get(host)
+        if limiter is not None:
+            limiter.acquire()
+        logger.info(f"请求高德瓦片: {url}")
+        started = time.monotonic()
+        try:
+            r = self.get(host, url, headers)
+        except requests.exceptions.RequestException:
+            self.record(host, started)
+            raise
+        finally:
+            self.admission.release(host)
+        self.record(host, started, r.status_code)
+        return r
+
+    def try_hedge_host(self, ranked, primary):
+        """选出对冲服务器并占用名额，没有可用服务器或没有空位时返回 None"""
+        secondary = self.pick(ranked, exclude=(primary,))
+        if secondary is not None and not self.admission.try_acquire(secondary):
+            self.health[secondary].release()
+            return None
+        return secondary
+
+    def fetch(self, style, z, x, y, headers=None):
+        """按健康状况选择服务器请求瓦片，必要时发送对冲请求"""
+        ranked = self.ranked_hosts(x, y)
+        primary = self.pick(ranked) or ranked[0]
+        try:
+            self.admission.acquire(primary, getattr(fetch_context, "background", False))
+        except UpstreamOverloaded:
+            self.health[primary].release()
+            raise
+        if not self.hedge_enabled:
+            return self._timed_get(primary, style, z, x, y, headers)
+
+        first = self.executor.submit(self._timed_get, primary, style, z, x, y, headers)
+        try:
+            return first.result(timeout=self.hedge_deadline(primary))
+        except FutureTimeoutError:
+            pass
+        secondary = self.try_hedge_host(ranked, primary)
+        if secondary is None:
+            return first.result()
+        self.hedged += 1
+        second = self.executor.submit(self._timed_get, secondary, style, z, x, y, headers)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def health_stats(self):
+        return {
+            "hosts": {host: self.health[host].snapshot() for host in self.servers},
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "admission": self.admission.stats(),
+        }
+
+    def stats(self):
+        hosts = {}
+        for host in self.servers:
+            pools = self.adapters[host].poolmanager.pools
+            num_requests = num_connections = 0
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+            hosts[host] = {
+                "requests": num_requests,
+                "connections": num_connections,
+                "reuse_ratio": round(1 - num_connections / num_requests, 4) if num_requests else None,
+            }
+        return hosts
+
+upstream_client = UpstreamClient(AMAP_SERVERS, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT,
+                                 UPSTREAM_READ_TIMEOUT, UPSTREAM_RETRIES, UPSTREAM_BACKOFF)
+
+# 条件请求时上游返回 304
+NOT_MODIFIED = object()
+# 回源验证时上游出错（5xx、429 等），继续使用过期副本
+UPSTREAM_FAILED = object()
+
+def fetch_upstream_tile(key, modified_since=None):
+    """请求高德上游瓦片，有效时返回内容，否则返回 None
+
+    modified_since 为缓存副本的时间戳时发送条件请求，上游未修改则返回 NOT_MODIFIED，
+    上游出错则返回 UPSTREAM_FAILED。
+    """
+    style, z, x, y = key
+    headers = {"If-Modified-Since": http_date(modified_since)} if modified_since else None
+    r = upstream_client.fetch(style, z, x, y, headers)
+    return check_upstream_tile(key, r.status_code, r.content, has_stale=modified_since is not None)
+
+def is_blank_image(data):
+    """解码后是否为纯色图片（容许 BLANK_TILE_TOLERANCE 的压缩误差），没有 Pillow 时一律视为普通瓦片"""
+    if Image is None:
+        return False
+    try:
+        with Image.open(BytesIO(data)) as img:
+            extrema = img.convert("RGB").getextrema()
+    except Exception:
+        return False
+    return all(high - low <= BLANK_TILE_TOLERANCE for low, high in extrema)
+
+def check_upstream_tile(key, status_code, content, has_stale=False):
+    """校验上游响应，有效瓦片返回内容（空白瓦片返回去重后的 BlankTile），否则记入负缓存并返回 None
+
+    has_stale 为真（有过期副本可用）时，上游出错不记入负缓存，返回 UPSTREAM_FAILED。
+    """
+    if status_code == 304:
+        return NOT_MODIFIED
+    if status_code == 200 and len(content) > 1000:  # 检查内容长度
+        if negative_cache and len(content) <= BLANK_TILE_MAX_BYTES and is_blank_image(content):
+            return negative_cache.put_blank(key, content) or content
+        return content
+    UPSTREAM_REJECTED.inc("short" if status_code == 200 else "status")
+    logger.warning(f"瓦片获取失败: 状态码={status_code}, 长度={len(content)}")
+    if has_stale and status_code not in (200, 404):
+        return UPSTREAM_FAILED
+    if negative_cache:
+        negative_cache.put(key, NEGATIVE_CACHE_TTL if status_code in (200, 404) else NEGATIVE_ERROR_TTL)
+    return None
+
+def store_tile(key, data, to_disk=True):
+    """把瓦片写入内存缓存与磁盘缓存（空白瓦片已由负缓存保存，补位瓦片不缓存，均跳过）"""
+    if isinstance(data, (BlankTile, FallbackTile)):
+        return
+    if memory_cache:
+        memory_cache.put(key, data)
+    if tile_cache and to_disk:
+        try:
+            tile_cache.put(key, data)
+        except OSError as e:
+            logger.warning(f"瓦片缓存写入失败: {e}")
+
+def _load_tile_miss(key):
+    if offline_archive:
+        data = offline_archive.get(key)
+        if data is not None:
+            TILE_SOURCES.inc("offline")
+            store_tile(key, data, to_disk=False)
+            return data
+        if not OFFLINE_UPSTREAM_FALLBACK:
+            return None
+
+    stale = None
+    if tile_cache:
+        data = tile_cache.get(key)
+        if data is not None:
+            TILE_SOURCES.inc("disk")
+            store_tile(key, data, to_disk=False)
+            return data
+        stale = tile_cache.get_stale(key)
+
+    if SYNTH_UNDERZOOM and SYNTH_MAX_LEVELS:
+        data = synthesize_from_children(key)
+        if data is not None:
+            TILE_SOURCES.inc("underzoom")
+            store_tile(key, data)
+            return data
+
+    if fetch_locks:
+        stripe, waited = fetch_locks.acquire(key)
+        try:
+            # 等锁期间其他工作进程可能已经取回了这个瓦片
+            data = tile_cache.get(key) if waited else None
+            if data is not None:
+                TILE_SOURCES.inc("disk")
+                store_tile(key, data, to_disk=False)
+                return data
+            return _fetch_tile_miss(key, stale)
+        finally:
+            fetch_locks.release(stripe)
+    return _fetch_tile_miss(key, stale)
+
+def _fetch_tile_miss(key, stale):
+    TILE_SOURCES.inc("upstream")
+    foreground = prefetcher is not None and not getattr(fetch_context, "background", False)
+    if foreground:
+        prefetcher.foreground_begin()
+    try:
+        data = fetch_upstream_tile(key, modified_since=stale[1] if stale else None)
+    except requests.exceptions.RequestException as e:
+        if stale is None:
+            raise
+        logger.warning(f"回源验证失败，继续使用过期缓存 {key}: {e}")
+        TILE_SOURCES.inc("stale")
+        return stale[0]
+    finally:
+        if foreground:
+            prefetcher.foreground_end()
+    return revalidated_tile(key, data, stale)
+
+def revalidated_tile(key, data, stale):
+    """处理（条件）回源结果：未修改或内容相同则只刷新过期缓存的有效期，上游出错则返回过期副本"""
+    if data is UPSTREAM_FAILED:
+        logger.warning(f"回源验证失败，继续使用过期缓存 {key}")
+        TILE_SOURCES.inc("stale")
+        return stale[0]
+    if stale is not None and (data is NOT_MODIFIED or data == stale[0]):
+        tile_cache.touch(key)
+        store_tile(key, stale[0], to_disk=False)
+        return stale[0]
+    if data is NOT_MODIFIED:
+        # 没有本地副本却收到 304，按无效瓦片处理
+        return None
+    if data is not None:
+        store_tile(key, data)
+    return data
+
+def load_negative(key):
+    """查负缓存，返回 (是否命中, 空白瓦片或 None)"""
+    if not negative_cache:
+        return False, None
+    found, blank = negative_cache.get(key)
+    if found:
+        TILE_SOURCES.inc("negative" if blank is None else "blank")
+    return found, blank
+
+def load_tile(key):
+    """按 内存 -> 负缓存 -> 磁盘 -> 上游 的顺序获取 GCJ 瓦片，同一瓦片的并发未命中只请求一次
+
+    超过上游最大级别的瓦片由祖先瓦片合成；上游没有可用瓦片时尝试用已缓存的祖先或子瓦片补位。
+    """
+    if memory_cache:
+        data = memory_cache.get(key)
+        if data is not None:
+            TILE_SOURCES.inc("memory")
+            return data
+    found, blank = load_negative(key)
+    if found:
+        return blank if blank is not None else synthesize_tile(key)
+    if SYNTH_MAX_LEVELS and key[1] > UPSTREAM_MAX_ZOOM:
+        return tile_flight.do(key, lambda: _load_overzoom_miss(key))
+    try:
+        data = tile_flight.do(key, lambda: _load_tile_miss(key))
+    except UpstreamOverloaded:
+        data = synthesize_tile(key)
+        if data is None:
+            raise
+    return data if data is not None else synthesize_tile(key)
+
+# ===== 像素级重投影 =====
+TILE_SIZE = 256
+REPROJECTED_STYLE_FLAG = 0x40  # 重投影输出瓦片在缓存中的 style 标记，与上游 GCJ 瓦片区分
+REPROJECT_GRID_NODES = 17      # 每边采样节点数，节点之间线性插值
+
+def _interp_matrix(nodes, size):
+    """把粗网格节点线性插值到像素中心的权重矩阵 (size, nodes)"""
+    pos = (np.arange(size) + 0.5) * (nodes - 1) / size
+    left = np.minimum(pos.astype(np.int64), nodes - 2)
+    frac = pos - left
+    weights = np.zeros((size, nodes))
+    weights[np.arange(size), left] = 1 - frac
+    weights[np.arange(size), left + 1] = frac
+    return weights
+
+class ReprojectionGrid:
+    """WGS84 输出瓦片到 GCJ 上游瓦片拼接图的最近邻采样表"""
+    __slots__ = ("z", "tx0", "ty0", "cols", "rows", "index")
+
+    def __init__(self, z, tx0, ty0, cols, rows, index):
+        self.z = z
+        self.tx0 = tx0
+        self.ty0 = ty0
+        self.cols = cols
+        self.rows = rows
+        self.index = index
+
+    def source_keys(self):
+        return [(TILE_STYLE, self.z, self.tx0 + c, self.ty0 + r) for r in range(self.rows) for c in range(self.cols)]
+
+@lru_cache(maxsize=REPROJECT_GRID_CACHE)
+def reprojection_grid(z, x, y):
+    """计算 WGS84 瓦片 (z, x, y) 每个像素在 GCJ 拼接图中的位置（按瓦片缓存）"""
+    n = TILE_SIZE * 2.0 ** z
+    nodes = np.linspace(0, TILE_SIZE, REPROJECT_GRID_NODES)
+    px, py = np.meshgrid(x * TILE_SIZE + nodes, y * TILE_SIZE + nodes)
+    lng = px / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * py / n))))
+    gcj_lng, gcj_lat = wgs84_to_gcj02_array(lng, lat)
+    gx = (gcj_lng + 180.0) / 360.0 * n
+    gy = (1.0 - np.arcsinh(np.tan(np.radians(gcj_lat))) / np.pi) / 2.0 * n
+
+    weights = _INTERP_WEIGHTS
+    gx = weights @ gx @ weights.T
+    gy = weights @ gy @ weights.T
+
+    max_tile = 2 ** z - 1
+    tx0 = min(max(int(gx.min() // TILE_SIZE), 0), max_tile)
+    ty0 = min(max(int(gy.min() // TILE_SIZE), 0), max_tile)
+    tx1 = min(max(int(gx.max() // TILE_SIZE), 0), max_tile)
+    ty1 = min(max(int(gy.max() // TILE_SIZE), 0), max_tile)
+    cols, rows = tx1 - tx0 + 1, ty1 - ty0 + 1
+
+    ix = np.clip(np.floor(gx).astype(np.int32) - tx0 * TILE_SIZE, 0, cols * TILE_SIZE - 1)
+    iy = np.clip(np.floor(gy).astype(np.int32) - ty0 * TILE_SIZE, 0, rows * TILE_SIZE - 1)
+    index = (iy * (cols * TILE_SIZE) + ix).ravel()
+    index.flags.writeable = False
+    return ReprojectionGrid(z, tx0, ty0, cols, rows, index)
+
+def decode_tile(data):
+    with Image.open(BytesIO(data)) as img:
+        return np.asarray(img.convert("RGB"))
+
+def encode_tile(pixels):
+    buf = BytesIO()
+    Image.fromarray(pixels).save(buf, "JPEG", quality=REPROJECT_JPEG_QUALITY)
+    return buf.getvalue()
+
+def warp_tiles(grid, sources):
+    """按采样表把 1-4 张上游瓦片拼接并重采样成 256x256 JPEG，全部缺失时返回 None"""
+    if all(data is None for data in sources):
+        return None
+    mosaic = np.full((grid.rows * TILE_SIZE, grid.cols * TILE_SIZE, 3), 0xEE, dtype=np.uint8)
+    for i, data in enumerate(sources):
+        if data is None:
+            continue
+        r, c = divmod(i, grid.cols)
+        mosaic[r * TILE_SIZE:(r + 1) * TILE_SIZE, c * TILE_SIZE:(c + 1) * TILE_SIZE] = decode_tile(data)
+    return encode_tile(mosaic.reshape(-1, 3)[grid.index].reshape(TILE_SIZE, TILE_SIZE, 3))
+
+def _load_reprojected_miss(z, x, y):
+    grid = reprojection_grid(z, x, y)
+    keys = grid.source_keys()
+    if len(keys) == 1:
+        sources = [load_tile(keys[0])]
+    else:
+        sources = list(reproject_executor.map(load_tile, keys))
+    return store_reprojected((TILE_STYLE | REPROJECTED_STYLE_FLAG, z, x, y), sources, warp_tiles(grid, sources))
+
+def store_reprojected(key, sources, data):
+    """缓存重投影结果
+
+    由补位瓦片拼出、或有来源瓦片缺失（缺口填成灰色，可能只是上游暂时出错）的结果同样只是补位，
+    返回给客户端但不写缓存。
+    """
+    if data is None:
+        return None
+    if any(source is None or isinstance(source, FallbackTile) for source in sources):
+        return FallbackTile(data)
+    store_tile(key, data)
+    return data
+
+def load_reprojected_tile(z, x, y):
+    """获取按像素重投影到 WGS84 的瓦片"""
+    key = (TILE_STYLE | REPROJECTED_STYLE_FLAG, z, x, y)
+    if memory_cache:
+        data = memory_cache.get(key)
+        if data is not None:
+            return data
+    if tile_cache:
+        data = tile_cache.get(key)
+        if data is not None:
+            store_tile(key, data, to_disk=False)
+            return data
+    return tile_flight.do(key, lambda: _load_reprojected_miss(z, x, y))
+
+if REPROJECT_MODE == "pixel" and np is None:
+    logger.error("像素级重投影需要 numpy 与 Pillow，已回退到整瓦片模式")
+    REPROJECT_MODE = "tile"
+if np is not None:
+    _INTERP_WEIGHTS = _interp_matrix(REPROJECT_GRID_NODES, TILE_SIZE)
+reproject_executor = ThreadPoolExecutor(max_workers=REPROJECT_FETCH_WORKERS, thread_name_prefix="reproject")
+
+# ===== 跨级合成 =====
+def _bilinear_axis(offset, scale):
+    """目标像素中心在祖先瓦片中的坐标，返回 (左侧像素下标, 插值权重)"""
+    pos = np.clip(offset + (np.arange(TILE_SIZE) + 0.5) / scale - 0.5, 0, TILE_SIZE - 1)
+    left = np.minimum(pos.astype(np.int64), TILE_SIZE - 2)
+    return left, (pos - left).astype(np.float32)
+
+def overzoom_pixels(data, levels, x, y):
+    """从 levels 级之上的祖先瓦片中取出 (x, y) 覆盖的区域，双线性放大到 256x256
+
+    插值直接在整张祖先瓦片上进行，相邻的合成瓦片在边界处连续。
+    """
+    scale = 1 << levels
+    size = TILE_SIZE // scale
+    pixels = decode_tile(data).astype(np.float32)
+    cols, fx = _bilinear_axis((x % scale) * size, scale)
+    rows, fy = _bilinear_axis((y % scale) * size, scale)
+    fx = fx[None, :, None]
+    top = pixels[rows][:, cols] * (1 - fx) + pixels[rows][:, cols + 1] * fx
+    bottom = pixels[rows + 1][:, cols] * (1 - fx) + pixels[rows + 1][:, cols + 1] * fx
+    fy = fy[:, None, None]
+    return np.rint(top * (1 - fy) + bottom * fy).astype(np.uint8)
+
+def underzoom_pixels(children):
+    """把 2x2 个子瓦片（左上、右上、左下、右下）拼接后按 2x2 像素块取平均，缩小到 256x256"""
+    mosaic = np.empty((2 * TILE_SIZE, 2 * TILE_SIZE, 3), dtype=np.uint16)
+    for i, data in enumerate(children):
+        r, c = divmod(i, 2)
+        mosaic[r * TILE_SIZE:(r + 1) * TILE_SIZE, c * TILE_SIZE:(c + 1) * TILE_SIZE] = decode_tile(data)
+    return ((mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 3).sum(axis=(1, 3)) + 2) // 4).astype(np.uint8)
+
+def cached_tile(key):
+    """只查缓存（内存、空白瓦片、离线包、磁盘含过期副本），不回源"""
+    if memory_cache:
+        data = memory_cache.get(key)
+        if data is not None:
+            return data
+    if negative_cache:
+        found, blank = negative_cache.get(key)
+        if found:
+            return blank
+    if offline_archive:
+        data = offline_archive.get(key)
+        if data is not None:
+            return data
+    if tile_cache:
+        stale = tile_cache.get_stale(key)
+        if stale is not None:
+            return stale[0]
+    return None
+
+def synthesize_from_ancestor(key, max_levels):
+    style, z, x, y = key
+    for levels in range(1, min(max_levels, z) + 1):
+        data = cached_tile((style, z - levels, x >> levels, y >> levels))
+        if data is not None:
+            return data if isinstance(data, BlankTile) else encode_tile(overzoom_pixels(data, levels, x, y))
+    return None
+
+def synthesize_from_children(key):
+    style, z, x, y = key
+    if z >= UPSTREAM_MAX_ZOOM:
+        return None
+    children = []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            data = cached_tile((style, z + 1, 2 * x + dx, 2 * y + dy))
+            if data is None:
+                return None
+            children.append(data)
+    return encode_tile(underzoom_pixels(children))
+
+def synthesize_tile(key):
+    """上游没有可用瓦片（不存在、出错或过载）时，用已缓存的祖先或子瓦片合成一张补位，不回源也不写缓存"""
+    if not SYNTH_MAX_LEVELS or getattr(fetch_context, "background", False):
+        return None
+    try:
+        data = synthesize_from_ancestor(key, SYNTH_MAX_LEVELS) or synthesize_from_children(key)
+    except Exception as e:
+        logger.warning(f"合成瓦片 {key} 失败: {e}")
+        return None
+    if data is None:
+        return None
+    TILE_SOURCES.inc("fallback")
+    return data if isinstance(data, BlankTile) else FallbackTile(data)
+
+def overzoom_parent(key):
+    """超过上游最大级别的瓦片对应的祖先瓦片键与级差，超出 SYNTH_MAX_LEVELS 或 MAX_TILE_ZOOM 时返回 None"""
+    style, z, x, y = key
+    levels = z - UPSTREAM_MAX_ZOOM
+    if levels > SYNTH_MAX_LEVELS or z > MAX_TILE_ZOOM:
+        return None
+    return (style, UPSTREAM_MAX_ZOOM, x >> levels, y >> levels), levels
+
+def store_overzoom(key, parent, levels):
+    """由祖先瓦片合成并像普通瓦片一样写入缓存；祖先是补位瓦片时结果同样只是补位，不写缓存"""
+    if isinstance(parent, BlankTile):
+        return parent
+    data = encode_tile(overzoom_pixels(parent, levels, key[2], key[3]))
+    if isinstance(parent, FallbackTile):
+        return FallbackTile(data)
+    TILE_SOURCES.inc("overzoom")
+    store_tile(key, data)
+    return data
+
+def _load_overzoom_miss(key):
+    if tile_cache:
+        data = tile_cache.get(key)
+        if data is not None:
+            TILE_SOURCES.inc("disk")
+            store_tile(key, data, to_disk=False)
+            return data
+    target = overzoom_parent(key)
+    if target is None:
+        return None
+    parent_key, levels = target
+    parent = load_tile(parent_key)
+    return store_overzoom(key, parent, levels) if parent is not None else None
+
+if SYNTH_MAX_LEVELS and np is None:
+    logger.warning("跨级合成需要 numpy 与 Pillow，已关闭")
+    SYNTH_MAX_LEVELS = 0
+
+# ===== HTTP 缓存 =====
+def tile_etag(data):
+    """由瓦片内容计算的强 ETag（不含引号）"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def tile_response(data, fmt="jpeg"):
+    """返回瓦片：带 ETag 与 Cache-Control，If-None-Match 匹配时返回 304
+
+    fmt 为协商出的 WebP/AVIF 时返回转码后的变体，ETag 为 JPEG 的 ETag 加格式后缀，
+    条件请求命中时不需要转码。
+    """
+    etag = tile_etag(data)
+    mimetype = "image/jpeg"
+    # 补位瓦片只让浏览器短暂缓存，上游恢复后尽快换成真实瓦片
+    max_age = NEGATIVE_ERROR_TTL if isinstance(data, FallbackTile) else TILE_MAX_AGE
+    if fmt != "jpeg":
+        variant_etag = f"{etag}-{fmt}"
+        if etag_matches(request.headers.get("If-None-Match"), variant_etag):
+            etag, mimetype = variant_etag, TileTranscoder.MIMETYPES[fmt]
+        else:
+            variant = transcoder.transcode(data, etag, fmt).result()
+            if variant:
+                transcoder.record(len(data), len(variant))
+                data, etag, mimetype = variant, variant_etag, TileTranscoder.MIMETYPES[fmt]
+    response = send_file(BytesIO(data), mimetype=mimetype, etag=etag, max_age=max_age, conditional=True)
+    if transcoder:
+        response.vary.add("Accept")
+    return response
+
+def etag_matches(if_none_match, etag):
+    """按 If-None-Match 头（弱比较）判断是否匹配"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
+
+# ===== 格式转换 =====
+class TileTranscoder:
+    """把上游 JPEG 瓦片转码为 WebP/AVIF
+
+    转码在独立线程池中进行（Pillow 编码时释放 GIL），结果按 (JPEG ETag, 格式) 缓存在内存中，
+    同一变体的并发请求只编码一次。转码失败或结果不比 JPEG 小时缓存空结果，之后直接返回 JPEG。
+    """
+    MIMETYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+
+    def __init__(self, formats, quality, workers, cache_bytes):
+        self.formats = formats
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self.cache = MemoryTileCache(cache_bytes)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.encoded = 0
+        self.failed = 0
+        self.not_smaller = 0
+        self.served = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def transcode(self, data, etag, fmt):
+        """返回转码结果的 Future，结果为空字节串表示应返回 JPEG"""
+        key = (etag, fmt)
+        variant = self.cache.get(key)
+        if variant is not None:
+            future = Future()
+            future.set_result(variant)
+            return future
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = self.executor.submit(self._encode, data, key)
+        return future
+
+    def _encode(self, data, key):
+        fmt = key[1]
+        try:
+            with Image.open(BytesIO(data)) as image:
+                buf = BytesIO()
+                image.convert("RGB").save(buf, fmt.upper(), quality=self.quality)
+            variant = buf.getvalue()
+            with self.lock:
+                self.encoded += 1
+            if len(variant) >= len(data):
+                with self.lock:
+                    self.not_smaller += 1
+                variant = b""
+        except Exception as e:
+            logger.warning(f"瓦片转码失败 ({fmt}): {e}")
+            with self.lock:
+                self.failed += 1
+            variant = b""
+        self.cache.put(key, variant)
+        with self.lock:
+            self.pending.pop(key, None)
+        return variant
+
+    def record(self, original_bytes, variant_bytes):
+        with self.lock:
+            self.served += 1
+            self.bytes_in += original_bytes
+            self.bytes_out += variant_bytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "formats": self.formats,
+                "encoded": self.encoded,
+                "failed": self.failed,
+                "not_smaller": self.not_smaller,
+                "cache_hits": self.cache.hits,
+                "cache_bytes": self.cache.bytes,
+                "served": self.served,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+            }
+
+def negotiate_format(accept):
+    """按 Accept 头选择瓦片格式（TILE_FORMATS 中靠前的优先），客户端都不接受时返回 jpeg"""
+    if not transcoder or not accept:
+        return "jpeg"
+    accepted = set()
+    for part in accept.split(","):
+        media, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media.strip().lower())
+    for fmt in transcoder.formats:
+        if f"image/{fmt}" in accepted:
+            return fmt
+    return "jpeg"
+
+def create_transcoder():
+    if not TILE_FORMATS:
+        return None
+    if Image is None:
+        logger.warning("未安装 Pillow，不支持 WebP/AVIF 转码")
+        return None
+    from PIL import features
+
+    formats = []
+    for fmt in TILE_FORMATS:
+        if fmt in ("webp", "avif") and features.check(fmt):
+            formats.append(fmt)
+        else:
+            logger.warning(f"不支持的瓦片格式: {fmt}")
+    return TileTranscoder(formats, TRANSCODE_QUALITY, TRANSCODE_WORKERS, TRANSCODE_CACHE_BYTES) if formats else None
+
+transcoder = create_transcoder()
+
+# ===== 预取 =====
+class TilePrefetcher:
+    """后台预取邻近瓦片
+
+    每服务一个瓦片 (z, x, y)，把周围 ring 圈的邻居和 z+1 的四个子瓦片排入有界队列
+    （已排队的去重，满了丢弃最旧的预测，后进先出）。只要有前台请求正在回源，
+    预取线程就暂停，保证前台优先。
+    """
+    def __init__(self, workers, queue_size, ring, max_zoom):
+        self.queue_size = queue_size
+        self.ring = ring
+        self.max_zoom = max_zoom
+        self.queue = deque()
+        self.pending = set()
+        self.prefetched = OrderedDict()
+        self.foreground = 0
+        self.cond = threading.Condition()
+        self.enqueued = 0
+        self.dropped = 0
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.hits = 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"prefetch-{i}", daemon=True).start()
+
+    def schedule(self, z, x, y):
+        n = 1 << z
+        candidates = [(z, (x + dx) % n, y + dy)
+                      for dy in range(-self.ring, self.ring + 1)
+                      for dx in range(-self.ring, self.ring + 1)
+                      if (dx or dy) and 0 <= y + dy < n]
+        if z < self.max_zoom:
+            candidates += [(z + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+        with self.cond:
+            for tile in candidates:
+                if tile in self.pending:
+                    continue
+                if len(self.queue) >= self.queue_size:
+                    self.pending.discard(self.queue.popleft())
+                    self.dropped += 1
+                self.queue.append(tile)
+                self.pending.add(tile)
+                self.enqueued += 1
+            self.cond.notify(len(candidates))
+
+    def record_request(self, z, x, y):
+        """前台请求到达时调用，用于统计预取命中率"""
+        if (z, x, y) in self.prefetched:
+            with self.cond:
+                if self.prefetched.pop((z, x, y), None) is not None:
+                    self.hits += 1
+
+    def foreground_begin(self):
+        with self.cond:
+            self.foreground += 1
+
+    def foreground_end(self):
+        with self.cond:
+            self.foreground -= 1
+            if self.foreground == 0:
+                self.cond.notify_all()
+
+    def _worker(self):
+        fetch_context.background = True
+        while True:
+            with self.cond:
+                while not self.queue or self.foreground > 0:
+                    self.cond.wait()
+                tile = self.queue.pop()
+                self.pending.discard(tile)
+            z, x, y = tile
+            try:
+                if self._is_cached(z, x, y):
+                    outcome = "skipped"
+                else:
+                    data = load_reprojected_tile(z, x, y) if REPROJECT_MODE == "pixel" else load_tile(self._gcj_key(z, x, y))
+                    outcome = "fetched" if data is not None else "failed"
+            except Exception as e:
+                logger.debug(f"预取失败 {tile}: {e}")
+                outcome = "failed"
+            with self.cond:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+                if outcome == "fetched":
+                    self.prefetched[tile] = True
+                    while len(self.prefetched) > self.queue_size * 10:
+                        self.prefetched.popitem(last=False)
+
+    def _gcj_key(self, z, x, y):
+        gcj_x, gcj_y = tile_index.lookup(z, x, y)
+        return (TILE_STYLE, z, gcj_x, gcj_y)
+
+    def _is_cached(self, z, x, y):
+        key = (TILE_STYLE | REPROJECTED_STYLE_FLAG, z, x, y) if REPROJECT_MODE == "pixel" else self._gcj_key(z, x, y)
+        if memory_cache and key in memory_cache.entries:
+            return True
+        if negative_cache and negative_cache.contains(key):
+            return True
+        return bool(tile_cache and tile_cache.contains(key))
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.fetched, 4) if self.fetched else None,
+        }
+
+prefetcher = TilePrefetcher(PREFETCH_WORKERS, PREFETCH_QUEUE_SIZE, PREFETCH_RING, PREFETCH_MAX_ZOOM) if PREFETCH_ENABLED else None
 
 @app.route("/")
 def index():
@@ -436,7 +2998,7 @@ def debug_tile(z, x, y):
         # 坐标转换计算
         wgs84_lng, wgs84_lat = tile_to_lnglat(x, y, z)
         gcj_lng, gcj_lat = wgs84_to_gcj02(wgs84_lng, wgs84_lat)
-        gcj_x, gcj_y = lnglat_to_tile(gcj_lng, gcj_lat, z)
+        gcj_x, gcj_y = tile_index.lookup(z, x, y)
         
         return {
             "client_ip": client_ip,
@@ -476,6 +3038,80 @@ def save_location():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route("/api/convert", methods=['POST'])
+def convert_points():
+    """批量坐标转换
+
+    direction 取 wgs84_to_gcj02（默认）或 gcj02_to_wgs84。
+    JSON 请求体: {"direction": ..., "points": [[lng, lat], ...]}，返回同结构 JSON；
+    application/octet-stream 请求体: 小端 float64 的 lng,lat 交替序列，返回同格式二进制。
+    结果按块流式返回。
+    """
+    if np is None:
+        return jsonify({"error": "批量坐标转换需要 numpy"}), 501
+
+    binary = request.mimetype == "application/octet-stream"
+    if binary:
+        direction = request.args.get("direction", "wgs84_to_gcj02")
+        if request.content_length is not None and request.content_length % 16:
+            return jsonify({"error": "二进制请求体长度应为 16 字节（lng, lat 两个 float64）的整数倍"}), 400
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("points"), list):
+            return jsonify({"error": "请求体应为 {\"points\": [[lng, lat], ...]}"}), 400
+        direction = data.get("direction", request.args.get("direction", "wgs84_to_gcj02"))
+
+    converters = {"wgs84_to_gcj02": wgs84_to_gcj02_array, "gcj02_to_wgs84": gcj02_to_wgs84_array}
+    if direction not in converters:
+        return jsonify({"error": f"不支持的转换方向: {direction}"}), 400
+    convert = converters[direction]
+
+    def convert_chunk(points):
+        lng, lat = convert(points[:, 0], points[:, 1])
+        return np.column_stack((lng, lat))
+
+    if binary:
+        chunk_bytes = CONVERT_CHUNK_POINTS * 16
+        stream = request.stream
+
+        def generate_binary():
+            pending = b""
+            while True:
+                block = stream.read(chunk_bytes - len(pending))
+                if not block:
+                    break
+                pending += block
+                if len(pending) < chunk_bytes:
+                    continue
+                yield convert_chunk(np.frombuffer(pending, dtype="<f8").reshape(-1, 2)).astype("<f8").tobytes()
+                pending = b""
+            if len(pending) % 16:
+                # 没有 Content-Length 时无法提前拒绝，只能中断响应，不能悄悄丢掉末尾不完整的点
+                raise ValueError(f"二进制请求体末尾有 {len(pending) % 16} 字节不完整的坐标")
+            if pending:
+                yield convert_chunk(np.frombuffer(pending, dtype="<f8").reshape(-1, 2)).astype("<f8").tobytes()
+
+        return Response(generate_binary(), mimetype="application/octet-stream")
+
+    try:
+        points = np.asarray(data["points"], dtype=np.float64)
+    except (TypeError, ValueError):
+        return jsonify({"error": "points 应为 [[lng, lat], ...]"}), 400
+    if points.size == 0:
+        points = points.reshape(0, 2)
+    elif points.ndim != 2 or points.shape[1] != 2:
+        return jsonify({"error": "points 应为 [[lng, lat], ...]"}), 400
+
+    def generate_json():
+        yield f'{{"direction": "{direction}", "points": ['
+        for start in range(0, len(points), CONVERT_CHUNK_POINTS):
+            rows = convert_chunk(points[start:start + CONVERT_CHUNK_POINTS]).tolist()
+            body = json.dumps(rows)[1:-1]
+            yield body if start == 0 else ", " + body
+        yield "]}"
+
+    return Response(generate_json(), mimetype="application/json")
+
 @app.route("/api/location/<location>")
 def get_preset_location(location):
     if location in PRESET_LOCATIONS:
@@ -484,60 +3120,815 @@ def get_preset_location(location):
 
 @app.route("/amap/<int:z>/<int:x>/<int:y>.jpg")
 def get_tile(z, x, y):
+    started = time.perf_counter()
+    status = 500
     try:
-        # 获取客户端位置信息
-        client_ip = location_service.get_client_ip()
-        base_location = location_service.determine_best_location(client_ip)
-        
-        base_lng = base_location['lng']
-        base_lat = base_location['lat']
-        
-        logger.info(f"请求瓦片: z={z}, x={x}, y={y}, 基准位置: {base_location}")
-        
-        # 计算瓦片中心坐标
-        tile_center_lng, tile_center_lat = tile_to_lnglat(x, y, z)
-        
-        # 计算相对偏移并应用坐标转换
-        offset_lng = tile_center_lng - base_lng
-        offset_lat = tile_center_lat - base_lat
-        
-        target_lng = base_lng + offset_lng
-        target_lat = base_lat + offset_lat
-        
-        # 坐标转换
-        gcj_lng, gcj_lat = wgs84_to_gcj02(target_lng, target_lat)
-        gcj_x, gcj_y = lnglat_to_tile(gcj_lng, gcj_lat, z)
-        
-        # 请求高德瓦片 - 使用HTTP而不是HTTPS
-        server_num = (gcj_x + gcj_y) % 4
-        url = f"http://webrd0{server_num+1}.is.autonavi.com/appmaptile?lang=zh_cn&size=1&scale=1&style=8&x={gcj_x}&y={gcj_y}&z={z}"
-        
-        logger.info(f"请求高德瓦片: {url}")
-        
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Referer": "https://www.amap.com/"
-        }
+        logger.info(f"请求瓦片: z={z}, x={x}, y={y}")
+        if not valid_tile(z, x, y):
+            status = 404
+            return Response("Tile not found", status=404)
         
-        # 增加超时时间
-        r = requests.get(url, headers=headers, timeout=15)
+        # 坐标转换（查映射索引）
+        gcj_x, gcj_y = tile_index.lookup(z, x, y)
+        mapped = time.perf_counter()
+        TILE_STAGE_SECONDS.observe(mapped - started, "mapping")
         
-        if r.status_code == 200 and len(r.content) > 1000:  # 检查内容长度
-            return send_file(BytesIO(r.content), mimetype="image/jpeg")
+        if REPROJECT_MODE == "pixel":
+            data = load_reprojected_tile(z, x, y)
         else:
-            logger.warning(f"瓦片获取失败: 状态码={r.status_code}, 长度={len(r.content)}")
+            data = load_tile((TILE_STYLE, z, gcj_x, gcj_y))
+        loaded = time.perf_counter()
+        TILE_STAGE_SECONDS.observe(loaded - mapped, "load")
+        if prefetcher:
+            prefetcher.record_request(z, x, y)
+        if data is None:
+            status = 404
             return Response("Tile not found", status=404)
+        if prefetcher:
+            prefetcher.schedule(z, x, y)
+        response = tile_response(data, negotiate_format(request.headers.get("Accept")))
+        TILE_STAGE_SECONDS.observe(time.perf_counter() - loaded, "response")
+        status = response.status_code
+        return response
             
+    except UpstreamOverloaded as e:
+        logger.warning(f"上游繁忙，拒绝请求: {e}")
+        status = 503
+        return Response("Upstream busy", status=503, headers={"Retry-After": "1"})
     except requests.exceptions.RequestException as e:
         logger.error(f"网络请求失败: {e}")
+        status = 503
         return Response("Network error", status=503)
     except Exception as e:
         logger.error(f"获取瓦片失败: {e}")
         return Response("Service error", status=500)
+    finally:
+        TILE_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+        TILE_RESPONSES.inc(str(status))
+
+@app.route("/api/cache/stats")
+def cache_stats():
+    """缓存命中统计"""
+    return jsonify({
+        "memory": memory_cache.stats() if memory_cache else None,
+        "negative": negative_cache.stats() if negative_cache else None,
+        "disk": tile_cache.stats() if tile_cache else None,
+        "singleflight": tile_flight.stats(),
+        "async_singleflight": async_tile_server.stats() if async_tile_server else None,
+        "tile_index": tile_index.stats(),
+        "geoip": location_service.stats(),
+        "prefetch": prefetcher.stats() if prefetcher else None,
+        "transcode": transcoder.stats() if transcoder else None,
+        "fetch_locks": fetch_locks.stats() if fetch_locks else None,
+        "pid": os.getpid(),
+    })
+
+@app.route("/api/upstream/stats")
+def upstream_stats():
+    """上游连接池复用统计"""
+    return jsonify(upstream_client.stats())
+
+@app.route("/api/upstream/health")
+def upstream_health():
+    """各上游服务器的延迟、错误率与熔断状态"""
+    return jsonify(upstream_client.health_stats())
 
 @app.route("/health")
 def health():
     return "OK"
 
+def render_metrics():
+    """生成 Prometheus 文本格式的监控指标"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, stats in (("amap_memory_cache", memory_cache.stats() if memory_cache else None),
+                          ("amap_negative_cache", negative_cache.stats() if negative_cache else None),
+                          ("amap_disk_cache", tile_cache.stats() if tile_cache else None),
+                          ("amap_singleflight", tile_flight.stats()),
+                          ("amap_async_singleflight", async_tile_server.stats() if async_tile_server else None),
+                          ("amap_geoip", location_service.stats()),
+                          ("amap_prefetch", prefetcher.stats() if prefetcher else None),
+                          ("amap_transcode", transcoder.stats() if transcoder else None),
+                          ("amap_fetch_locks", fetch_locks.stats() if fetch_locks else None)):
+        if stats:
+            lines.extend(render_gauges(prefix, stats))
+    health = upstream_client.health_stats()
+    lines.append("# TYPE amap_upstream_breaker_state gauge")
+    for host, state in health["hosts"].items():
+        for name in ("closed", "open", "half_open"):
+            value = 1 if state["state"] == name else 0
+            lines.append(f'amap_upstream_breaker_state{{host="{host}",state="{name}"}} {value}')
+    lines.extend(render_gauges("amap_upstream", {"hedged": health["hedged"], "hedge_wins": health["hedge_wins"]}))
+    lines.extend(render_gauges("amap_upstream_admission", health["admission"]))
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus 指标"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# ===== 批量下载 =====
+BATCH_RECORD = struct.Struct(">BIIHI")  # z, x, y, 状态码, 数据长度
+BATCH_MIMETYPE = "application/x-amap-tile-batch"
+BATCH_BOUNDARY = "amap-tile-batch"
+
+class BatchRequestError(ValueError):
+    pass
+
+def _batch_worker_init():
+    # 批量下载按后台优先级排队，上游繁忙时先让出给浏览请求
+    fetch_context.background = True
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch", initializer=_batch_worker_init)
+
+def parse_batch_tiles(params):
+    """解析批量请求，返回 (瓦片数, WGS84 瓦片迭代器)
+
+    tiles 为 [[z, x, y], ...] 或 "z/x/y,z/x/y"；也可以给出 bbox（min_lng,min_lat,max_lng,max_lat）
+    与 zoom（"12" 或 "10-14"），按范围枚举。范围枚举是惰性的，大批量不会先生成完整列表。
+    """
+    tiles = params.get("tiles")
+    if tiles is not None:
+        if isinstance(tiles, str):
+            tiles = [tile.split("/") for tile in tiles.split(",") if tile.strip()]
+        try:
+            tiles = [tuple(int(v) for v in tile) for tile in tiles]
+        except (TypeError, ValueError):
+            raise BatchRequestError("tiles 格式应为 [[z, x, y], ...] 或 z/x/y,z/x/y")
+        for tile in tiles:
+            if len(tile) != 3 or not valid_tile(*tile):
+                raise BatchRequestError(f"无效的瓦片: {tile}")
+        return len(tiles), iter(tiles)
+
+    bbox, zoom = params.get("bbox"), params.get("zoom")
+    if bbox is None or zoom is None:
+        raise BatchRequestError("需要 tiles，或 bbox 与 zoom")
+    try:
+        bbox = parse_bbox(bbox if isinstance(bbox, str) else ",".join(str(v) for v in bbox))
+        zooms = parse_zoom_range(str(zoom))
+    except argparse.ArgumentTypeError as e:
+        raise BatchRequestError(str(e))
+    except (TypeError, ValueError):
+        raise BatchRequestError(f"无效的范围或缩放级别: bbox={bbox}, zoom={zoom}")
+    ranges = [(z, *bbox_tile_range(bbox, z)) for z in zooms]
+    total = sum((x1 - x0 + 1) * (y1 - y0 + 1) for _, x0, y0, x1, y1 in ranges)
+    tiles = ((z, x, y) for z, x0, y0, x1, y1 in ranges for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+    return total, tiles
+
+def load_batch_tile(tile):
+    """获取一个 WGS84 瓦片，返回 (tile, 状态码, 数据)，错误不抛出"""
+    z, x, y = tile
+    try:
+        if REPROJECT_MODE == "pixel":
+            data = load_reprojected_tile(z, x, y)
+        else:
+            gcj_x, gcj_y = tile_index.lookup(z, x, y)
+            data = load_tile((TILE_STYLE, z, gcj_x, gcj_y))
+        status = 200 if data is not None else 404
+    except (UpstreamOverloaded, requests.exceptions.RequestException):
+        data, status = None, 503
+    except Exception as e:
+        logger.error(f"批量获取瓦片 {tile} 失败: {e}")
+        data, status = None, 500
+    BATCH_TILES.inc(str(status))
+    return tile, status, data
+
+def iter_batch(tiles, concurrency):
+    """并发获取瓦片，按完成顺序产出结果；同时在途的瓦片不超过 concurrency 个，内存占用与批量大小无关"""
+    pending = set()
+    try:
+        for tile in tiles:
+            if len(pending) >= concurrency:
+                done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(batch_executor.submit(load_batch_tile, tile))
+        while pending:
+            done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # 客户端提前断开时，尚未开始的瓦片不再获取
+        for future in pending:
+            future.cancel()
+
+def encode_batch_binary(results):
+    """长度前缀二进制流：每个瓦片为 15 字节头（z, x, y, 状态码, 长度，大端）加瓦片数据"""
+    for (z, x, y), status, data in results:
+        data = data or b""
+        yield BATCH_RECORD.pack(z, x, y, status, len(data)) + data
+
+def encode_batch_multipart(results):
+    """multipart/mixed 流：每个瓦片一个部分，Content-Location 为瓦片地址，X-Tile-Status 为状态码"""
+    for (z, x, y), status, data in results:
+        data = data or b""
+        content_type = "image/jpeg" if data else "text/plain"
+        yield (f"--{BATCH_BOUNDARY}\r\nContent-Type: {content_type}\r\nContent-Location: /amap/{z}/{x}/{y}.jpg\r\n"
+               f"X-Tile-Status: {status}\r\nContent-Length: {len(data)}\r\n\r\n").encode() + data + b"\r\n"
+    yield f"--{BATCH_BOUNDARY}--\r\n".encode()
+
+@app.route("/api/tiles/batch", methods=["GET", "POST"])
+def batch_tiles():
+    """批量下载瓦片：POST JSON 或 GET 查询参数，结果按完成顺序流式返回
+
+    format=binary（默认）返回长度前缀二进制流，format=multipart 返回 multipart/mixed。
+    """
+    params = request.get_json(silent=True) if request.method == "POST" else None
+    if not isinstance(params, dict):
+        params = request.values.to_dict()
+    try:
+        total, tiles = parse_batch_tiles(params)
+    except BatchRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    if total > BATCH_MAX_TILES:
+        return jsonify({"error": f"瓦片数 {total} 超过上限 {BATCH_MAX_TILES}"}), 400
+    fmt = params.get("format", "binary")
+    if fmt not in ("binary", "multipart"):
+        return jsonify({"error": f"不支持的格式: {fmt}"}), 400
+
+    logger.info(f"批量下载: {total} 个瓦片, 格式 {fmt}")
+    results = iter_batch(tiles, max(1, BATCH_CONCURRENCY))
+    headers = {"X-Tile-Count": str(total), "Cache-Control": "no-store"}
+    if fmt == "multipart":
+        return Response(encode_batch_multipart(results), headers=headers,
+                        mimetype=f"multipart/mixed; boundary={BATCH_BOUNDARY}")
+    return Response(encode_batch_binary(results), headers=headers, mimetype=BATCH_MIMETYPE)
+
+# ===== 瓦片预热 =====
+class RateLimiter:
+    """简单的间隔限速器：每秒最多 rate 次"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+def parse_zoom_range(value):
+    """解析 "10-18" 或 "12" 形式的缩放级别范围"""
+    low, _, high = value.partition("-")
+    low = int(low)
+    high = int(high) if high else low
+    if not 0 <= low <= high <= 20:
+        raise argparse.ArgumentTypeError(f"无效的缩放级别范围: {value}")
+    return range(low, high + 1)
+
+def parse_bbox(value):
+    """解析 "min_lng,min_lat,max_lng,max_lat"（WGS84）"""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的范围: {value}")
+    if min_lng >= max_lng or min_lat >= max_lat:
+        raise argparse.ArgumentTypeError(f"无效的范围: {value}")
+    return min_lng, min_lat, max_lng, max_lat
+
+def city_bbox(name, radius):
+    """预设城市中心点周围 radius 度的范围"""
+    location = PRESET_LOCATIONS[name]
+    return location["lng"] - radius, location["lat"] - radius, location["lng"] + radius, location["lat"] + radius
+
+def enumerate_seed_keys(bbox, zooms):
+    """枚举范围内的 WGS84 瓦片，按 GCJ 缓存键去重"""
+    for z in zooms:
+        x0, y0, x1, y1 = bbox_tile_range(bbox, z)
+        seen = set()
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                gcj_x, gcj_y = tile_index.lookup(z, x, y)
+                key = (TILE_STYLE, z, gcj_x, gcj_y)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+def seed_tiles(keys, total, concurrency, rate, progress_interval=5.0):
+    """以有限并发、每个上游服务器限速的方式把瓦片写入磁盘缓存
+
+    已在缓存中的瓦片直接跳过，所以中断后重新执行同一命令即可续传。
+    限速作用在每个请求真正发往的服务器上（熔断、按延迟换服务器后同样生效）。预热不发对冲请求、
+    不做自动重试：等待限速时很容易触发对冲，重试则会绕过限速向同一服务器多发请求；失败的瓦片下次执行时续传。
+    """
+    global upstream_client
+    previous_client = upstream_client
+    upstream_client = UpstreamClient(previous_client.servers, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT,
+                                     UPSTREAM_READ_TIMEOUT, 0, 0.0)
+    upstream_client.rate_limiters = {host: RateLimiter(rate) for host in upstream_client.servers}
+    upstream_client.hedge_enabled = False
+    counts = {"done": 0, "skipped": 0, "fetched": 0, "empty": 0, "failed": 0, "bytes": 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    started = last_report = time.time()
+
+    def report(final=False):
+        elapsed = max(time.time() - started, 1e-6)
+        logger.info(
+            f"{'预热完成' if final else '预热进度'}: {counts['done']}/{total} "
+            f"(下载 {counts['fetched']}, 跳过 {counts['skipped']}, 空 {counts['empty']}, 失败 {counts['failed']}), "
+            f"{counts['fetched'] / elapsed:.1f} 瓦片/s, {counts['bytes'] / elapsed / 1024:.1f} KB/s"
+        )
+
+    def work(key):
+        outcome, size = "failed", 0
+        try:
+            if tile_cache.contains(key):
+                outcome = "skipped"
+            else:
+                try:
+                    data = fetch_upstream_tile(key)
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"预热请求失败 {key}: {e}")
+                    data = None
+                else:
+                    outcome = "fetched" if data is not None else "empty"
+                size = len(data) if data is not None else 0
+                if data is not None and not isinstance(data, BlankTile):
+                    # 空白瓦片只在内存中保存一份，不写磁盘
+                    tile_cache.put(key, data)
+        except Exception:
+            # 线程池会吞掉异常，这里记录下来并计为失败
+            logger.exception(f"预热瓦片出错 {key}")
+            outcome, size = "failed", 0
+        finally:
+            with lock:
+                counts[outcome] += 1
+                counts["done"] += 1
+                counts["bytes"] += size
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="seed") as executor:
+            try:
+                for key in keys:
+                    slots.acquire()
+                    executor.submit(work, key)
+                    if time.time() - last_report >= progress_interval:
+                        report()
+                        last_report = time.time()
+            except KeyboardInterrupt:
+                logger.warning("预热被中断，已缓存的瓦片会在下次执行时跳过")
+                executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        if upstream_client.executor is not None:
+            upstream_client.executor.shutdown(wait=False)
+        upstream_client = previous_client
+    report(final=True)
+    return counts
+
+def run_seed(args):
+    if not tile_cache:
+        logger.error("预热需要启用磁盘缓存（CACHE_ENABLED=true）")
+        return 1
+    bbox = args.bbox or city_bbox(args.city, args.radius)
+    total = 0
+    for z in args.zoom:
+        x0, y0, x1, y1 = bbox_tile_range(bbox, z)
+        total += max(0, x1 - x0 + 1) * max(0, y1 - y0 + 1)
+    logger.info(f"开始预热: 范围 {bbox}, 缩放级别 {args.zoom.start}-{args.zoom.stop - 1}, 约 {total} 个瓦片")
+    counts = seed_tiles(enumerate_seed_keys(bbox, args.zoom), total, args.concurrency, args.rate)
+    return 1 if counts["failed"] else 0
+
+# ===== 异步 ASGI 服务 =====
+TILE_PATH = re.compile(r"^/amap/(\d+)/(\d+)/(\d+)\.jpg$")
+
+class AsyncTileServer:
+    """ASGI 应用：瓦片路由走 asyncio + httpx 非阻塞路径，其余路由交给 Flask
+
+    缓存层与同步路径共用（内存缓存直接访问，磁盘读写放到线程池），
+    同一瓦片的并发未命中合并为一个 asyncio 任务。
+    """
+    def __init__(self, flask_app):
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.flask_asgi = WsgiToAsgi(flask_app)
+        self.client = None
+        self.flights = {}
+        self.executed = 0
+        self.coalesced = 0
+        # 持有回源锁期间的磁盘读写使用独立线程池，不与默认线程池中的其他任务争用
+        self.locked_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="async-locked")
+
+    def _run_locked(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.locked_executor, fn, *args)
+
+    def _create_client(self):
+        import httpx
+
+        return httpx.AsyncClient(
+            headers=UPSTREAM_HEADERS,
+            timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=UPSTREAM_ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=UPSTREAM_POOL_SIZE * len(AMAP_SERVERS)),
+            transport=httpx.AsyncHTTPTransport(retries=UPSTREAM_RETRIES),
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            match = TILE_PATH.match(scope["path"])
+            if match:
+                z, x, y = (int(v) for v in match.groups())
+                if_none_match = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"if-none-match"), None)
+                accept = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"accept"), None)
+                await self._serve_tile(z, x, y, scope["method"] == "HEAD", if_none_match, accept, send)
+                return
+        await self.flask_asgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.client = self._create_client()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _respond(self, send, status, body, content_type, head_only=False, extra_headers=()):
+        headers = [(b"content-type", content_type.encode())]
+        if status != 304:
+            headers.append((b"content-length", str(len(body)).encode()))
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers + list(extra_headers),
+        })
+        await send({"type": "http.response.body", "body": b"" if head_only else body})
+
+    async def _serve_tile(self, z, x, y, head_only, if_none_match, accept, send):
+        import httpx
+
+        started = time.perf_counter()
+        status = 500
+        try:
+            if not valid_tile(z, x, y):
+                status = 404
+                await self._respond(send, 404, b"Tile not found", "text/plain")
+                return
+            # 阶段划分与 Flask 路径（get_tile）一致
+            gcj_x, gcj_y = tile_index.lookup(z, x, y)
+            mapped = time.perf_counter()
+            TILE_STAGE_SECONDS.observe(mapped - started, "mapping")
+            if REPROJECT_MODE == "pixel":
+                data = await self.load_reprojected_tile(z, x, y)
+            else:
+                data = await self.load_tile((TILE_STYLE, z, gcj_x, gcj_y))
+            loaded = time.perf_counter()
+            TILE_STAGE_SECONDS.observe(loaded - mapped, "load")
+            if prefetcher:
+                prefetcher.record_request(z, x, y)
+            if data is None:
+                status = 404
+                await self._respond(send, 404, b"Tile not found", "text/plain")
+            else:
+                if prefetcher:
+                    prefetcher.schedule(z, x, y)
+                etag = tile_etag(data)
+                mimetype = "image/jpeg"
+                # 补位瓦片只让浏览器短暂缓存，上游恢复后尽快换成真实瓦片
+                max_age = NEGATIVE_ERROR_TTL if isinstance(data, FallbackTile) else TILE_MAX_AGE
+                fmt = negotiate_format(accept)
+                if fmt != "jpeg":
+                    variant_etag = f"{etag}-{fmt}"
+                    if etag_matches(if_none_match, variant_etag):
+                        etag, mimetype = variant_etag, TileTranscoder.MIMETYPES[fmt]
+                    else:
+                        variant = await asyncio.wrap_future(transcoder.transcode(data, etag, fmt))
+                        if variant:
+                            transcoder.record(len(data), len(variant))
+                            data, etag, mimetype = variant, variant_etag, TileTranscoder.MIMETYPES[fmt]
+                cache_headers = [(b"etag", f'"{etag}"'.encode()),
+                                 (b"cache-control", f"public, max-age={max_age}".encode())]
+                if transcoder:
+                    cache_headers.append((b"vary", b"Accept"))
+                status = 304 if etag_matches(if_none_match, etag) else 200
+                if status == 304:
+                    await self._respond(send, 304, b"", mimetype, extra_headers=cache_headers)
+                else:
+                    await self._respond(send, 200, data, mimetype, head_only, cache_headers)
+                TILE_STAGE_SECONDS.observe(time.perf_counter() - loaded, "response")
+        except UpstreamOverloaded as e:
+            logger.warning(f"上游繁忙，拒绝请求: {e}")
+            status = 503
+            await self._respond(send, 503, b"Upstream busy", "text/plain", extra_headers=[(b"retry-after", b"1")])
+        except httpx.HTTPError as e:
+            logger.error(f"网络请求失败: {e}")
+            status = 503
+            await self._respond(send, 503, b"Network error", "text/plain")
+        except Exception as e:
+            logger.error(f"获取瓦片失败: {e}")
+            await self._respond(send, 500, b"Service error", "text/plain")
+        finally:
+            TILE_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+            TILE_RESPONSES.inc(str(status))
+
+    async def load_tile(self, key):
+        """load_tile 的异步版本"""
+        if memory_cache:
+            data = memory_cache.get(key)
+            if data is not None:
+                TILE_SOURCES.inc("memory")
+                return data
+        found, blank = load_negative(key)
+        if found:
+            return blank if blank is not None else await asyncio.to_thread(synthesize_tile, key)
+        if SYNTH_MAX_LEVELS and key[1] > UPSTREAM_MAX_ZOOM:
+            return await self._flight(key, lambda: self._load_overzoom_miss(key))
+        try:
+            data = await self._flight(key, lambda: self._load_tile_miss(key))
+        except UpstreamOverloaded:
+            data = await asyncio.to_thread(synthesize_tile, key)
+            if data is None:
+                raise
+        return data if data is not None else await asyncio.to_thread(synthesize_tile, key)
+
+    async def _load_overzoom_miss(self, key):
+        if tile_cache:
+            data = await asyncio.to_thread(tile_cache.get, key)
+            if data is not None:
+                TILE_SOURCES.inc("disk")
+                store_tile(key, data, to_disk=False)
+                return data
+        target = overzoom_parent(key)
+        if target is None:
+            return None
+        parent_key, levels = target
+        parent = await self.load_tile(parent_key)
+        if parent is None:
+            return None
+        return await asyncio.to_thread(store_overzoom, key, parent, levels)
+
+    async def load_reprojected_tile(self, z, x, y):
+        """load_reprojected_tile 的异步版本：并发获取上游瓦片，采样表与重采样放到线程池，并发未命中合并"""
+        key = (TILE_STYLE | REPROJECTED_STYLE_FLAG, z, x, y)
+        if memory_cache:
+            data = memory_cache.get(key)
+            if data is not None:
+                return data
+        if tile_cache:
+            data = await asyncio.to_thread(tile_cache.get, key)
+            if data is not None:
+                store_tile(key, data, to_disk=False)
+                return data
+        return await self._flight(key, lambda: self._load_reprojected_miss(key, z, x, y))
+
+    async def _load_reprojected_miss(self, key, z, x, y):
+        grid = await asyncio.to_thread(reprojection_grid, z, x, y)
+        sources = await asyncio.gather(*(self.load_tile(k) for k in grid.source_keys()))
+        data = await asyncio.to_thread(warp_tiles, grid, sources)
+        return await asyncio.to_thread(store_reprojected, key, sources, data)
+
+    def _flight(self, key, start):
+        """同一键的并发未命中只执行一次 start() 返回的协程，其余调用者等待同一个任务"""
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(start())
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        return asyncio.shield(task)
+
+    async def _load_tile_miss(self, key):
+        if offline_archive:
+            data = offline_archive.get(key)
+            if data is not None:
+                TILE_SOURCES.inc("offline")
+                store_tile(key, data, to_disk=False)
+                return data
+            if not OFFLINE_UPSTREAM_FALLBACK:
+                return None
+
+        stale = None
+        if tile_cache:
+            data = await asyncio.to_thread(tile_cache.get, key)
+            if data is not None:
+                TILE_SOURCES.inc("disk")
+                store_tile(key, data, to_disk=False)
+                return data
+            stale = await asyncio.to_thread(tile_cache.get_stale, key)
+
+        if SYNTH_UNDERZOOM and SYNTH_MAX_LEVELS:
+            data = await asyncio.to_thread(synthesize_from_children, key)
+            if data is not None:
+                TILE_SOURCES.inc("underzoom")
+                store_tile(key, data)
+                return data
+
+        if fetch_locks:
+            stripe, waited = await fetch_locks.acquire_async(key)
+            try:
+                # 等锁期间其他工作进程可能已经取回了这个瓦片
+                data = await self._run_locked(tile_cache.get, key) if waited else None
+                if data is not None:
+                    TILE_SOURCES.inc("disk")
+                    store_tile(key, data, to_disk=False)
+                    return data
+                return await self._fetch_tile_miss(key, stale)
+            finally:
+                fetch_locks.release(stripe)
+        return await self._fetch_tile_miss(key, stale)
+
+    async def _fetch_tile_miss(self, key, stale):
+        import httpx
+
+        TILE_SOURCES.inc("upstream")
+
+        headers = {"If-Modified-Since": http_date(stale[1])} if stale else None
+        if prefetcher:
+            prefetcher.foreground_begin()
+        try:
+            r = await self.fetch_upstream(key, headers)
+        except (httpx.HTTPError, UpstreamOverloaded) as e:
+            if stale is None:
+                raise
+            logger.warning(f"回源验证失败，继续使用过期缓存 {key}: {e}")
+            TILE_SOURCES.inc("stale")
+            return stale[0]
+        finally:
+            if prefetcher:
+                prefetcher.foreground_end()
+        data = check_upstream_tile(key, r.status_code, r.content, has_stale=stale is not None)
+        return await self._run_locked(revalidated_tile, key, data, stale)
+
+    async def _timed_get(self, host, key, headers):
+        import httpx
+
+        style, z, x, y = key
+        url = upstream_client.tile_url(host, style, z, x, y)
+        logger.info(f"请求高德瓦片: {url}")
+        if self.client is None:
+            self.client = self._create_client()
+        started = time.monotonic()
+        try:
+            r = await self.client.get(url, headers=headers)
+        except httpx.HTTPError:
+            upstream_client.record(host, started)
+            raise
+        upstream_client.record(host, started, r.status_code)
+        return r
+
+    def _start_get(self, host, key, headers):
+        """发出请求（调用方已占用准入名额）；结束时释放名额，即使任务在开始前就被取消"""
+        task = asyncio.ensure_future(self._timed_get(host, key, headers))
+
+        def done(task):
+            upstream_client.admission.release(host)
+            if task.cancelled():
+                # 对冲落败被取消，不计入健康统计，但要释放熔断试探名额
+                upstream_client.health[host].release()
+
+        task.add_done_callback(done)
+        return task
+
+    async def fetch_upstream(self, key, headers=None):
+        """UpstreamClient.fetch 的异步版本：对冲请求胜出后取消另一个"""
+        _, _, x, y = key
+        ranked = upstream_client.ranked_hosts(x, y)
+        primary = upstream_client.pick(ranked) or ranked[0]
+        try:
+            await upstream_client.admission.acquire_async(primary)
+        except (UpstreamOverloaded, asyncio.CancelledError):
+            upstream_client.health[primary].release()
+            raise
+        first = self._start_get(primary, key, headers)
+        if not upstream_client.hedge_enabled:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=upstream_client.hedge_deadline(primary))
+        if done:
+            return first.result()
+        secondary = upstream_client.try_hedge_host(ranked, primary)
+        if secondary is None:
+            return await first
+        upstream_client.hedged += 1
+        second = self._start_get(secondary, key, headers)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if task is second:
+                        upstream_client.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def stats(self):
+        return {"in_flight": len(self.flights), "executed": self.executed, "coalesced": self.coalesced}
+
+# ASGI 模式下的实例（uvicorn app:create_asgi_app --factory 或 python app.py --mode asgi）
+async_tile_server = None
+
+def create_asgi_app():
+    global async_tile_server
+    async_tile_server = AsyncTileServer(app)
+    return async_tile_server
+
+# ===== 多进程服务 =====
+def init_worker(workers):
+    """gunicorn 工作进程 fork 后调用，重建不能跨进程共用的状态
+
+    坐标映射表、重投影网格等只读数据在主进程中准备好，fork 后以写时复制方式共享；
+    磁盘缓存索引是共享的 mmap（文件锁互斥），瓦片文件经操作系统页缓存共享。
+    """
+    global memory_cache, negative_cache, tile_flight, fetch_locks, upstream_client, prefetcher, location_service
+    # 进程内热点缓存每个进程各一份，未显式配置时按进程数均分默认预算
+    memory_bytes = MEMORY_CACHE_BYTES if "MEMORY_CACHE_BYTES" in os.environ else MEMORY_CACHE_BYTES // workers
+    memory_cache = MemoryTileCache(memory_bytes, CACHE_TTL) if memory_bytes > 0 else None
+    negative_cache = NegativeTileCache(NEGATIVE_CACHE_SIZE) if NEGATIVE_CACHE_SIZE > 0 else None
+    tile_flight = SingleFlight()
+    fetch_locks = TileFetchLocks(CACHE_DIR, CACHE_LOCK_STRIPES) if tile_cache and fcntl and workers > 1 else None
+    # 连接池、线程池和 GeoIP 读取器都按进程创建
+    upstream_client = UpstreamClient(AMAP_SERVERS, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT,
+                                     UPSTREAM_READ_TIMEOUT, UPSTREAM_RETRIES, UPSTREAM_BACKOFF, workers)
+    prefetcher = TilePrefetcher(PREFETCH_WORKERS, PREFETCH_QUEUE_SIZE, PREFETCH_RING, PREFETCH_MAX_ZOOM) if PREFETCH_ENABLED else None
+    location_service = LocationService(GEOIP_DB_PATH, GEOIP_CACHE_TTL, GEOIP_CACHE_SIZE)
+    if isinstance(offline_archive, MBTilesArchive):
+        offline_archive.local = threading.local()
+    logger.info(f"工作进程 {os.getpid()} 已就绪")
+
+def run_gunicorn(args):
+    """以 gunicorn 预派生多个工作进程提供服务"""
+    from gunicorn.app.base import BaseApplication
+
+    class TileProxyServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            if args.worker_class == "uvicorn":
+                self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            else:
+                self.cfg.set("worker_class", "gthread")
+                self.cfg.set("threads", args.threads)
+            self.cfg.set("post_fork", lambda server, worker: init_worker(args.workers))
+
+        def load(self):
+            return create_asgi_app() if args.worker_class == "uvicorn" else app
+
+    logger.info(f"启动 {args.workers} 个工作进程（{args.worker_class}）")
+    TileProxyServer().run()
+
+def main():
+    parser = argparse.ArgumentParser(description="高德地图瓦片代理")
+    parser.add_argument("--mode", choices=["flask", "asgi", "gunicorn"], default=os.environ.get("SERVER_MODE", "flask"),
+                        help="flask: Flask 开发服务器; asgi: uvicorn 异步服务; gunicorn: 多进程生产服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=env_int("PORT", 8280))
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="gunicorn 工作进程数")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="gthread 工作进程的线程数")
+    parser.add_argument("--worker-class", choices=["gthread", "uvicorn"], default=SERVER_WORKER_CLASS,
+                        help="gthread: 多线程 WSGI; uvicorn: 每进程一个异步事件循环")
+    subparsers = parser.add_subparsers(dest="command")
+
+    seed = subparsers.add_parser("seed", help="按范围和缩放级别预热磁盘缓存（可中断后续传）")
+    area = seed.add_mutually_exclusive_group(required=True)
+    area.add_argument("--city", choices=sorted(PRESET_LOCATIONS), help="预设城市")
+    area.add_argument("--bbox", type=parse_bbox, help="WGS84 范围: min_lng,min_lat,max_lng,max_lat")
+    seed.add_argument("--radius", type=float, default=0.2, help="城市中心点周围的范围（度）")
+    seed.add_argument("--zoom", type=parse_zoom_range, default=parse_zoom_range("10-18"), help="缩放级别，如 10-18")
+    seed.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    seed.add_argument("--rate", type=float, default=10.0, help="每个上游服务器每秒最多请求数")
+
+    export = subparsers.add_parser("export", help="把磁盘缓存导出为 MBTiles/PMTiles 离线瓦片包")
+    export.add_argument("output", help="输出文件，扩展名 .mbtiles 或 .pmtiles")
+    export.add_argument("--zoom", type=parse_zoom_range, help="只导出这些缩放级别，如 10-18")
+
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        sys.exit(run_seed(args))
+    elif args.command == "export":
+        if not tile_cache:
+            logger.error("导出需要启用磁盘缓存（CACHE_ENABLED=true）")
+            sys.exit(1)
+        if not args.output.endswith((".mbtiles", ".pmtiles")):
+            logger.error("输出文件扩展名应为 .mbtiles 或 .pmtiles")
+            sys.exit(1)
+        export_archive(args.output, args.zoom)
+    elif args.mode == "gunicorn":
+        run_gunicorn(args)
+    elif args.mode == "asgi":
+        import uvicorn
+
+        uvicorn.run(create_asgi_app(), host=args.host, port=args.port, log_level="warning")
+    else:
+        app.run(host=args.host, port=args.port, debug=False)
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8280, debug=False)
\ No newline at end of file
+    main()
@@ -0,0 +1,173 @@
+"""本地模拟的高德瓦片上游（webrdNN.is.autonavi.com/appmaptile），用于离线压测"""
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def base_jpeg():
+    """生成一张 256x256 的 JPEG；没有 Pillow 时退化为只带 JPEG 文件头的数据"""
+    if Image is None:
+        return b"\xff\xd8\xff\xe0" + bytes(2000) + b"\xff\xd9"
+    image = Image.new("RGB", (256, 256), (242, 239, 233))
+    for i in range(0, 256, 32):
+        image.paste((255, 255, 255), (i, 0, i + 4, 256))
+        image.paste((255, 220, 150), (0, i, 256, i + 6))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class FakeUpstream:
+    """按配置的延迟、抖动、错误率和瓦片大小返回瓦片，并统计收到的请求"""
+    def __init__(self, latency=0.03, jitter=0.02, error_rate=0.0, tile_size=(8000, 30000), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tile_size = tile_size
+        self.seed = seed
+        self.base = base_jpeg()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statuses = {}
+        self.tiles = set()
+        self.servers = []
+
+    def tile(self, z, x, y):
+        """同一坐标每次返回相同内容；大小在 tile_size 范围内，多出部分填在 JPEG 结束标记之后"""
+        crc = zlib.crc32(struct.pack("<Iii", z, x, y), self.seed)
+        low, high = self.tile_size
+        size = max(low + crc % (high - low + 1), len(self.base))
+        padding = random.Random(crc).randbytes(size - len(self.base))
+        return self.base + padding
+
+    def respond(self, query):
+        """返回 (状态码, 内容)"""
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            return 500, b"upstream error"
+        try:
+            z, x, y = (int(query[name][0]) for name in ("z", "x", "y"))
+        except (KeyError, ValueError):
+            return 400, b"bad request"
+        return 200, self.tile(z, x, y)
+
+    def record(self, status, query):
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == 200:
+                self.tiles.add(tuple(query.get(name, [""])[0] for name in ("z", "x", "y")))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "unique_tiles": len(self.tiles),
+                "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            }
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.statuses = {}
+            self.tiles = set()
+
+    def handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/stats":
+                    status, body, content_type = 200, json.dumps(upstream.stats()).encode(), "application/json"
+                else:
+                    query = parse_qs(url.query)
+                    status, body = upstream.respond(query)
+                    upstream.record(status, query)
+                    content_type = "image/jpeg" if status == 200 else "text/plain"
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 代理取消了对冲请求中较慢的一个
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0, count=1):
+        """启动 count 个监听端口（模拟 webrd01-04），返回 host:port 列表"""
+        addresses = []
+        for i in range(count):
+            server = FakeServer((host, port + i if port else 0), self.handler())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+            addresses.append(f"{host}:{server.server_address[1]}")
+        return addresses
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+def parse_size_range(value):
+    """解析 8000-30000 这样的字节范围"""
+    low, _, high = value.partition("-")
+    low = int(low)
+    high = int(high) if high else low
+    if low <= 1000 or high < low:
+        raise argparse.ArgumentTypeError("瓦片大小应大于 1000 字节，且上限不小于下限")
+    return low, high
+
+def add_upstream_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.03, help="上游平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.02, help="延迟抖动（秒，均匀分布 ±jitter）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--tile-size", type=parse_size_range, default=(8000, 30000), help="瓦片字节数范围，如 8000-30000")
+    parser.add_argument("--upstreams", type=int, default=4, help="模拟的上游服务器数量")
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟高德瓦片上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000, help="第一个端口，其余服务器依次递增")
+    parser.add_argument("--seed", type=int, default=0)
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(args.latency, args.jitter, args.error_rate, args.tile_size, args.seed)
+    addresses = upstream.start(args.host, args.port, args.upstreams)
+    print(f"AMAP_SERVERS={','.join(addresses)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        upstream.stop()
+
+if __name__ == "__main__":
+    main()
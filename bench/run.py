@@ -0,0 +1,230 @@
+"""瓦片代理压测：启动本地模拟上游和代理进程，回放浏览轨迹并输出吞吐、延迟、回源次数与内存
+
+示例:
+    python bench/run.py --mode asgi --sessions 16 --steps 40 --latency 0.05 --error-rate 0.01
+    python bench/run.py --env PREFETCH_ENABLED=true --json bench_output.json
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_upstream import FakeUpstream, add_upstream_arguments
+from traces import generate_trace, load_trace, save_trace
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def parse_env(value):
+    name, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("格式应为 KEY=VALUE")
+    return name, setting
+
+def parse_viewport(value):
+    cols, _, rows = value.partition("x")
+    return int(cols), int(rows)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def child_pids(pid):
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return pids
+
+def process_memory(pid):
+    """代理进程（含 gunicorn 工作进程）当前与峰值常驻内存之和（MB），只支持 Linux"""
+    memory = {}
+    for process in [pid] + child_pids(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in ("VmRSS", "VmHWM"):
+                        field = "rss_mb" if name == "VmRSS" else "peak_rss_mb"
+                        memory[field] = round(memory.get(field, 0) + int(value.split()[0]) / 1024, 1)
+        except OSError:
+            pass
+    return memory
+
+class ProxyProcess:
+    """以子进程方式运行 app.py，磁盘缓存放在临时目录"""
+    def __init__(self, mode, servers, extra_env):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.cache_dir = tempfile.mkdtemp(prefix="amap-bench-")
+        env = dict(os.environ)
+        env.update({
+            "AMAP_SERVERS": ",".join(servers),
+            "CACHE_ENABLED": "true",
+            "CACHE_DIR": self.cache_dir,
+            "GEOIP_DB_PATH": os.path.join(self.cache_dir, "missing.mmdb"),
+            "PYTHONUNBUFFERED": "1",
+        })
+        env.update(extra_env)
+        self.log = open(os.path.join(self.cache_dir, "proxy.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, APP_PATH, "--mode", mode, "--host", "127.0.0.1", "--port", str(self.port)],
+            env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        with open(self.log.name) as f:
+            sys.stderr.write(f.read()[-4000:])
+        raise RuntimeError("代理进程未能启动")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+def replay(base_url, trace, parallel):
+    """并发回放所有会话：每个会话逐屏加载，每屏最多 parallel 个并发请求；返回 (耗时, 延迟列表, 状态码计数)"""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def run_session(session):
+        http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=parallel)
+        http.mount("http://", adapter)
+
+        def fetch(tile):
+            z, x, y = tile
+            started = time.perf_counter()
+            try:
+                status = http.get(f"{base_url}/amap/{z}/{x}/{y}.jpg", timeout=30).status_code
+            except requests.exceptions.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for screen in session:
+                list(pool.map(fetch, screen))
+        http.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(trace)) as sessions:
+        list(sessions.map(run_session, trace))
+    return time.perf_counter() - started, latencies, statuses
+
+def summarize(name, elapsed, latencies, statuses, upstream, memory):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "pass": name,
+        "requests": count,
+        "statuses": {str(status): n for status, n in sorted(statuses.items(), key=str)},
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(count / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p90_ms": ms(percentile(latencies, 0.90)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "upstream_requests": upstream["requests"],
+        "upstream_unique_tiles": upstream["unique_tiles"],
+        "upstream_statuses": upstream["statuses"],
+        "upstream_per_request": round(upstream["requests"] / count, 3) if count else None,
+        **memory,
+    }
+
+def print_report(results):
+    columns = [("pass", 6), ("requests", 9), ("throughput_rps", 15), ("p50_ms", 9), ("p90_ms", 9),
+               ("p99_ms", 9), ("upstream_requests", 18), ("upstream_per_request", 21), ("rss_mb", 8), ("peak_rss_mb", 12)]
+    print("".join(name.ljust(width) for name, width in columns))
+    for result in results:
+        print("".join(str(result.get(name)).ljust(width) for name, width in columns))
+    for result in results:
+        print(f"[{result['pass']}] 代理状态码 {result['statuses']}，上游状态码 {result['upstream_statuses']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="瓦片代理压测（本地模拟上游，无需外网）")
+    parser.add_argument("--mode", choices=["flask", "asgi", "gunicorn"], default="flask",
+                        help="代理运行模式，gunicorn 的进程数用 --env WORKERS=N 指定")
+    parser.add_argument("--sessions", type=int, default=8, help="并发浏览会话数")
+    parser.add_argument("--steps", type=int, default=30, help="每个会话浏览的屏数")
+    parser.add_argument("--viewport", type=parse_viewport, default=(4, 3), help="每屏瓦片列数x行数，如 4x3")
+    parser.add_argument("--parallel", type=int, default=6, help="每个会话的并发请求数（浏览器每主机约 6 个）")
+    parser.add_argument("--passes", type=int, default=2, help="回放次数：第 1 次为冷缓存，之后为热缓存")
+    parser.add_argument("--seed", type=int, default=1, help="轨迹与模拟上游的随机种子")
+    parser.add_argument("--trace", help="从文件读取轨迹（而不是随机生成）")
+    parser.add_argument("--save-trace", help="把使用的轨迹写入文件，便于复现")
+    parser.add_argument("--env", type=parse_env, action="append", default=[],
+                        help="传给代理进程的环境变量，如 --env PREFETCH_ENABLED=true，可多次指定")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        cols, rows = args.viewport
+        trace = generate_trace(args.sessions, args.steps, cols, rows, args.seed)
+    if args.save_trace:
+        save_trace(trace, args.save_trace)
+
+    upstream = FakeUpstream(args.latency, args.jitter, args.error_rate, args.tile_size, args.seed)
+    servers = upstream.start(count=args.upstreams)
+    proxy = ProxyProcess(args.mode, servers, dict(args.env))
+    results = []
+    try:
+        proxy.wait_ready()
+        for i in range(args.passes):
+            upstream.reset()
+            elapsed, latencies, statuses = replay(proxy.url, trace, args.parallel)
+            name = "cold" if i == 0 else f"warm{i}" if args.passes > 2 else "warm"
+            results.append(summarize(name, elapsed, latencies, statuses, upstream.stats(),
+                                     process_memory(proxy.process.pid)))
+    finally:
+        proxy.stop()
+        upstream.stop()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": {name: value for name, value in vars(args).items() if name not in ("json", "env")}
+                       | {"env": dict(args.env)}, "results": results}, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""生成可复现的平移/缩放浏览轨迹（WGS84 瓦片坐标）"""
+import json
+import math
+import random
+
+# 轨迹起点（与 app.py 的预设城市一致）
+CITIES = [
+    (116.3974, 39.9093),  # 北京
+    (121.4737, 31.2304),  # 上海
+    (113.2644, 23.1291),  # 广州
+    (114.0579, 22.5431),  # 深圳
+    (104.0665, 30.5728),  # 成都
+]
+
+def lnglat_to_tile(lng, lat, zoom):
+    n = 2 ** zoom
+    x = int((lng + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return x, y
+
+def viewport(z, x, y, cols, rows):
+    """以 (x, y) 为中心的一屏瓦片，按离中心的距离排序（与地图客户端的加载顺序相同）"""
+    n = 2 ** z
+    tiles = []
+    for dy in range(-(rows // 2), rows - rows // 2):
+        for dx in range(-(cols // 2), cols - cols // 2):
+            ty = y + dy
+            if 0 <= ty < n:
+                tiles.append((dx * dx + dy * dy, (z, (x + dx) % n, ty)))
+    return [tile for _, tile in sorted(tiles)]
+
+def generate_session(rng, steps, cols, rows, min_zoom=3, max_zoom=18):
+    """一次浏览：从某个城市开始，多数时候沿惯性方向平移，偶尔放大或缩小"""
+    lng, lat = rng.choice(CITIES)
+    z = rng.randint(11, 15)
+    x, y = lnglat_to_tile(lng, lat, z)
+    dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+    session = []
+    for _ in range(steps):
+        session.append(viewport(z, x, y, cols, rows))
+        action = rng.random()
+        if action < 0.15 and z < max_zoom:
+            z, x, y = z + 1, x * 2 + rng.randint(0, 1), y * 2 + rng.randint(0, 1)
+        elif action < 0.3 and z > min_zoom:
+            z, x, y = z - 1, x // 2, y // 2
+        else:
+            if rng.random() < 0.3:
+                dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, -1)])
+            x, y = x + dx, min(max(y + dy, 0), 2 ** z - 1)
+    return session
+
+def generate_trace(sessions, steps, cols=4, rows=3, seed=1):
+    """返回 sessions 个浏览轨迹，每个轨迹是 steps 屏瓦片列表"""
+    rng = random.Random(seed)
+    return [generate_session(rng, steps, cols, rows) for _ in range(sessions)]
+
+def save_trace(trace, path):
+    with open(path, "w") as f:
+        json.dump(trace, f)
+
+def load_trace(path):
+    """读取轨迹文件：[[[[z, x, y], ...], ...], ...]（会话 -> 屏 -> 瓦片）"""
+    with open(path) as f:
+        return [[[tuple(tile) for tile in screen] for screen in session] for session in json.load(f)]
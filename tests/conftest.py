@@ -0,0 +1,44 @@
+"""测试公共设置：导入 app 前固定环境变量，上游指向本地模拟服务器，不访问外网"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+os.environ.setdefault("AMAP_SERVERS", "127.0.0.1:9")
+os.environ.setdefault("CACHE_ENABLED", "false")
+os.environ.setdefault("GEOIP_DB_PATH", os.path.join(ROOT, "tests", "missing.mmdb"))
+os.environ.setdefault("UPSTREAM_RETRIES", "0")
+
+import pytest
+
+import app as app_module
+from fake_upstream import FakeUpstream
+
+@pytest.fixture
+def app():
+    return app_module
+
+@pytest.fixture
+def caches(monkeypatch, tmp_path):
+    """每个测试使用独立的内存、负缓存与磁盘缓存"""
+    monkeypatch.setattr(app_module, "tile_cache", app_module.DiskTileCache(str(tmp_path / "cache"), 64 * 1024 ** 2, 3600))
+    monkeypatch.setattr(app_module, "memory_cache", app_module.MemoryTileCache(16 * 1024 ** 2, 3600))
+    monkeypatch.setattr(app_module, "negative_cache", app_module.NegativeTileCache(1000))
+    monkeypatch.setattr(app_module, "tile_flight", app_module.SingleFlight())
+    return app_module
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """本地模拟上游，返回 FakeUpstream；代理的上游客户端改为指向它"""
+    fake = FakeUpstream(latency=0.001, jitter=0.0)
+    servers = fake.start(count=2)
+    client = app_module.UpstreamClient(servers, 8, 2.0, 5.0, 0, 0.0)
+    monkeypatch.setattr(app_module, "upstream_client", client)
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
@@ -0,0 +1,75 @@
+"""离线瓦片包（MBTiles / PMTiles）导出与读取"""
+import sqlite3
+
+import pytest
+
+def fill_cache(app, count=200):
+    """写入 count 个瓦片：一部分内容相同（海洋）、一部分相邻编号相同（游程），其余各不相同"""
+    tiles = {}
+    z = 12
+    for i in range(count):
+        x, y = 3300 + i % 20, 1500 + i // 20
+        if i % 5 == 0:
+            data = b"\xff\xd8\xff" + b"ocean" * 300
+        else:
+            data = b"\xff\xd8\xff" + b"tile %d " % i * 200
+        tiles[(z, x, y)] = data
+        app.tile_cache.put((app.TILE_STYLE, z, x, y), data)
+    for x, y in ((0, 0), (1, 1)):
+        tiles[(1, x, y)] = b"\xff\xd8\xff" + b"low %d" % x * 300
+        app.tile_cache.put((app.TILE_STYLE, 1, x, y), tiles[(1, x, y)])
+    return tiles
+
+def assert_round_trip(app, archive, tiles):
+    for (z, x, y), data in tiles.items():
+        assert bytes(archive.get((app.TILE_STYLE, z, x, y))) == data, (z, x, y)
+    assert archive.get((app.TILE_STYLE, 12, 0, 0)) is None
+    assert archive.get((app.TILE_STYLE, 1, 1, 0)) is None
+
+def test_mbtiles_round_trip(app, caches, tmp_path):
+    tiles = fill_cache(app)
+    path = str(tmp_path / "tiles.mbtiles")
+    assert app.export_archive(path) == len(tiles)
+    archive = app.open_archive(path)
+    assert isinstance(archive, app.MBTilesArchive)
+    assert_round_trip(app, archive, tiles)
+    with sqlite3.connect(path) as conn:
+        metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+        # MBTiles 使用 TMS 行号（y 轴向上）
+        row = conn.execute("SELECT tile_row FROM tiles WHERE zoom_level=1 AND tile_column=0").fetchone()
+    assert (metadata["format"], metadata["minzoom"], metadata["maxzoom"]) == ("jpg", "1", "12")
+    assert row == (1,)
+
+@pytest.mark.parametrize("root_max_bytes", [16384 - 127, 64])
+def test_pmtiles_round_trip(app, caches, tmp_path, monkeypatch, root_max_bytes):
+    # 根目录上限调小后强制拆出叶目录
+    monkeypatch.setattr(app.PMTilesArchive, "ROOT_MAX_BYTES", root_max_bytes)
+    tiles = fill_cache(app)
+    path = str(tmp_path / "tiles.pmtiles")
+    assert app.export_archive(path) == len(tiles)
+    archive = app.open_archive(path)
+    assert isinstance(archive, app.PMTilesArchive)
+    assert_round_trip(app, archive, tiles)
+    assert len(archive.offsets) == len(tiles)
+
+    header = archive.HEADER.unpack_from(archive._mm, 0)
+    leaf_length = header[7]
+    addressed, entries, contents = header[10:13]
+    assert (leaf_length > 0) == (root_max_bytes == 64)
+    assert addressed == len(tiles)
+    # 相同内容只存一份
+    assert contents == len(set(tiles.values())) < entries <= addressed
+
+def test_pmtiles_rejects_unsorted_tiles(app, tmp_path):
+    tiles = [((2, 1, 1), b"a"), ((1, 0, 0), b"b")]
+    metadata = {"format": "jpg", "minzoom": 1, "maxzoom": 2, "bounds": [0, 0, 1, 1]}
+    with pytest.raises(ValueError):
+        app.PMTilesArchive.write(str(tmp_path / "bad.pmtiles"), tiles, metadata)
+
+def test_pmtiles_tile_id(app):
+    assert [app.pmtiles_tile_id(0, 0, 0), app.pmtiles_tile_id(1, 0, 0), app.pmtiles_tile_id(1, 0, 1),
+            app.pmtiles_tile_id(1, 1, 1), app.pmtiles_tile_id(1, 1, 0), app.pmtiles_tile_id(2, 0, 0)] == [0, 1, 2, 3, 4, 5]
+
+def test_export_empty_cache_fails(app, caches, tmp_path):
+    with pytest.raises(ValueError):
+        app.export_archive(str(tmp_path / "empty.mbtiles"))
@@ -0,0 +1,37 @@
+"""批量下载接口"""
+
+def parse_records(app, body):
+    records = []
+    offset = 0
+    while offset < len(body):
+        z, x, y, status, length = app.BATCH_RECORD.unpack_from(body, offset)
+        offset += app.BATCH_RECORD.size
+        records.append((z, x, y, status, body[offset:offset + length]))
+        offset += length
+    assert offset == len(body)
+    return records
+
+def test_world_bbox_is_clamped_to_tile_grid(app, caches, upstream, client):
+    response = client.get("/api/tiles/batch?bbox=-180,-90,180,90&zoom=0-1")
+    assert response.status_code == 200
+    assert response.headers["X-Tile-Count"] == "5"
+    records = parse_records(app, response.data)
+    assert sorted((z, x, y) for z, x, y, _, _ in records) == [(0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+    assert all(status == 200 and data for _, _, _, status, data in records)
+
+def test_bbox_tile_range_stays_inside_grid(app):
+    for z in (0, 1, 5, 18):
+        x0, y0, x1, y1 = app.bbox_tile_range((-180, -90, 180, 90), z)
+        assert (x0, y0, x1, y1) == (0, 0, (1 << z) - 1, (1 << z) - 1)
+
+def test_tile_list_multipart(app, caches, upstream, client):
+    response = client.post("/api/tiles/batch", json={"tiles": [[12, 3372, 1552], [12, 3373, 1552]], "format": "multipart"})
+    assert response.status_code == 200
+    assert response.data.count(b"X-Tile-Status: 200") == 2
+    assert response.data.endswith(b"--amap-tile-batch--\r\n")
+
+def test_malformed_requests_are_rejected(client):
+    assert client.get("/api/tiles/batch?tiles=25/0/0").status_code == 400
+    assert client.get("/api/tiles/batch?bbox=116,39,117,40&zoom=abc").status_code == 400
+    assert client.post("/api/tiles/batch", json={"bbox": 5, "zoom": 3}).status_code == 400
+    assert client.get("/api/tiles/batch?zoom=3").status_code == 400
@@ -0,0 +1,33 @@
+"""批量坐标转换接口"""
+import numpy as np
+
+def test_json_round_trip(client, app):
+    resp = client.post("/api/convert", json={"direction": "wgs84_to_gcj02", "points": [[116.3974, 39.9093], [0, 0]]})
+    assert resp.status_code == 200
+    points = resp.get_json()["points"]
+    assert points[0] == list(app.wgs84_to_gcj02(116.3974, 39.9093))
+    assert points[1] == [0, 0]
+
+def test_json_rejects_malformed_points(client):
+    for points in ([[1, 2, 3], [4, 5, 6]], [1, 2, 3, 4], [[[1, 2]]], [[1, 2], [3]], [["a", 2]]):
+        resp = client.post("/api/convert", json={"points": points})
+        assert resp.status_code == 400, points
+
+def test_json_empty_points(client):
+    resp = client.post("/api/convert", json={"points": []})
+    assert resp.status_code == 200
+    assert resp.get_json()["points"] == []
+
+def test_binary_round_trip(client, app):
+    points = np.array([[116.3974, 39.9093], [121.47, 31.23]], dtype="<f8")
+    resp = client.post("/api/convert?direction=gcj02_to_wgs84", data=points.tobytes(),
+                       content_type="application/octet-stream")
+    assert resp.status_code == 200
+    result = np.frombuffer(resp.data, dtype="<f8").reshape(-1, 2)
+    expected = np.array([app.gcj02_to_wgs84(*p) for p in points])
+    assert np.abs(result - expected).max() < 1e-11
+
+def test_binary_rejects_partial_point(client):
+    data = np.array([116.3974, 39.9093], dtype="<f8").tobytes() + b"\x00" * 8
+    resp = client.post("/api/convert", data=data, content_type="application/octet-stream")
+    assert resp.status_code == 400
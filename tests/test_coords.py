@@ -0,0 +1,42 @@
+"""WGS84 ⇄ GCJ-02 坐标转换"""
+import numpy as np
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # 覆盖中国范围内外，以及边界附近
+    return rng.uniform(70.0, 140.0, n), rng.uniform(0.0, 56.0, n)
+
+def test_forward_array_matches_scalar(app):
+    lng, lat = random_points(2000)
+    gcj_lng, gcj_lat = app.wgs84_to_gcj02_array(lng, lat)
+    expected = np.array([app.wgs84_to_gcj02(a, b) for a, b in zip(lng, lat)])
+    assert np.abs(gcj_lng - expected[:, 0]).max() < 1e-12
+    assert np.abs(gcj_lat - expected[:, 1]).max() < 1e-12
+
+def test_inverse_array_matches_scalar(app):
+    lng, lat = random_points(2000, seed=1)
+    wgs_lng, wgs_lat = app.gcj02_to_wgs84_array(lng, lat)
+    expected = np.array([app.gcj02_to_wgs84(a, b) for a, b in zip(lng, lat)])
+    assert np.abs(wgs_lng - expected[:, 0]).max() < 1e-11
+    assert np.abs(wgs_lat - expected[:, 1]).max() < 1e-11
+
+def test_inverse_round_trip(app):
+    lng, lat = random_points(50000, seed=2)
+    inside = (73.66 <= lng) & (lng <= 135.05) & (3.86 <= lat) & (lat <= 53.55)
+    wgs_lng, wgs_lat = app.gcj02_to_wgs84_array(lng, lat)
+    back_lng, back_lat = app.wgs84_to_gcj02_array(wgs_lng, wgs_lat)
+    # 紧贴边界的点求逆后可能落到范围外、不收敛（与逐点版本一致），只检查离边界 0.1 度以上的点
+    interior = (73.76 <= lng) & (lng <= 134.95) & (3.96 <= lat) & (lat <= 53.45)
+    assert np.abs(back_lng - lng)[interior].max() < 1e-9
+    assert np.abs(back_lat - lat)[interior].max() < 1e-9
+    assert (wgs_lng[~inside] == lng[~inside]).all() and (wgs_lat[~inside] == lat[~inside]).all()
+
+def test_inverse_keeps_input_shape(app):
+    lng, lat = random_points(12)
+    wgs_lng, wgs_lat = app.gcj02_to_wgs84_array(lng.reshape(3, 4), lat.reshape(3, 4))
+    assert wgs_lng.shape == wgs_lat.shape == (3, 4)
+    flat_lng, flat_lat = app.gcj02_to_wgs84_array(lng, lat)
+    assert (wgs_lng.ravel() == flat_lng).all() and (wgs_lat.ravel() == flat_lat).all()
+    point_lng, point_lat = app.gcj02_to_wgs84_array(116.4, 39.9)
+    assert point_lng.shape == ()
+    assert abs(float(point_lng) - app.gcj02_to_wgs84(116.4, 39.9)[0]) < 1e-11
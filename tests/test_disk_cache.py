@@ -0,0 +1,149 @@
+"""磁盘瓦片缓存：mmap 哈希索引的插入、删除、淘汰与重建"""
+import os
+import random
+import time
+
+import pytest
+
+STYLE = 7
+
+def make_cache(app, root, max_bytes=64 * 1024 ** 2, ttl=0):
+    return app.DiskTileCache(str(root), max_bytes, ttl)
+
+def tile_files(root):
+    files = set()
+    for dirpath, _, filenames in os.walk(os.path.join(root, "tiles")):
+        files.update(os.path.join(dirpath, name) for name in filenames if name.endswith(".jpg"))
+    return files
+
+def assert_consistent(app, cache):
+    """索引计数、字节数与槽位一致，每个条目都能从原位置探测到，并且都有对应文件"""
+    keys = cache.keys()
+    assert len(keys) == len(set(keys)) == cache.count
+    sizes = 0
+    with cache.lock.shared():
+        for key in keys:
+            slot = cache._find(app.pack_tile_key(key))
+            assert slot >= 0, key
+            sizes += cache.SLOT.unpack_from(cache._mm, cache._offset(slot))[1]
+    assert sizes == cache.total_bytes
+    assert {cache._path(key) for key in keys} == tile_files(cache.root)
+
+def random_keys(n, z=16, seed=0):
+    rng = random.Random(seed)
+    keys = set()
+    while len(keys) < n:
+        keys.add((STYLE, z, rng.randrange(1 << z), rng.randrange(1 << z)))
+    return sorted(keys)
+
+def test_put_get_and_reopen(app, tmp_path):
+    cache = make_cache(app, tmp_path)
+    keys = random_keys(50)
+    for i, key in enumerate(keys):
+        cache.put(key, b"tile-%d" % i)
+    cache.put(keys[0], b"replaced")
+    assert cache.get(keys[0]) == b"replaced"
+    assert cache.get((STYLE, 16, 1, 1)) is None
+    assert_consistent(app, cache)
+    cache.close()
+
+    reopened = make_cache(app, tmp_path)
+    assert reopened.count == 50
+    assert all(reopened.get(key) == (b"replaced" if i == 0 else b"tile-%d" % i) for i, key in enumerate(keys))
+    assert_consistent(app, reopened)
+
+def test_delete_keeps_probe_chains_intact(app, tmp_path):
+    cache = make_cache(app, tmp_path, max_bytes=1)
+    cache.max_bytes = 1 << 40  # 只用最小容量（1024 槽）的索引，不按字节淘汰
+    keys = random_keys(700, seed=1)
+    with cache.lock:
+        for key in keys:
+            cache._store(app.pack_tile_key(key), 1, 0)
+    rng = random.Random(2)
+    deleted = set(rng.sample(keys, 400))
+    with cache.lock:
+        for key in deleted:
+            cache._delete(cache._find(app.pack_tile_key(key)))
+        for key in keys:
+            assert (cache._find(app.pack_tile_key(key)) >= 0) == (key not in deleted), key
+    assert cache.count == len(keys) - len(deleted)
+    assert cache.total_bytes == cache.count
+
+def test_eviction_stays_within_budget(app, tmp_path):
+    cache = make_cache(app, tmp_path, max_bytes=100_000)
+    keys = random_keys(60, seed=3)
+    for key in keys:
+        cache.put(key, os.urandom(5000))
+        assert cache.total_bytes <= 100_000
+    assert cache.count == 20
+    assert cache.evictions == 40
+    assert_consistent(app, cache)
+
+def test_expired_entries_are_evicted_first(app, tmp_path):
+    cache = make_cache(app, tmp_path, max_bytes=50_000, ttl=3600)
+    keys = random_keys(10, seed=4)
+    for key in keys[:5]:
+        cache.put(key, bytes(10_000))
+    stale = keys[2]
+    with cache.lock:
+        slot = cache._find(app.pack_tile_key(stale))
+        packed, size, _, atime = cache.SLOT.unpack_from(cache._mm, cache._offset(slot))
+        cache.SLOT.pack_into(cache._mm, cache._offset(slot), packed, size, int(time.time()) - 7200, atime)
+    assert not cache.contains(stale)
+    cache.put(keys[5], bytes(10_000))
+    assert stale not in cache.keys()
+    assert all(cache.contains(key) for key in keys[:5] + keys[5:6] if key != stale)
+    assert_consistent(app, cache)
+
+def test_missing_file_is_dropped_from_index(app, tmp_path):
+    cache = make_cache(app, tmp_path)
+    key = random_keys(1)[0]
+    cache.put(key, b"data")
+    os.remove(cache._path(key))
+    assert cache.get(key) is None
+    assert cache.count == 0 and not cache.contains(key)
+
+def test_resize_rebuilds_index(app, tmp_path):
+    keys = random_keys(300, seed=5)
+    cache = make_cache(app, tmp_path, max_bytes=16 * 1024 ** 2)
+    for i, key in enumerate(keys):
+        cache.put(key, b"%03d" % i * 25)
+    cache.close()
+
+    bigger = make_cache(app, tmp_path, max_bytes=256 * 1024 ** 2)
+    assert bigger.capacity > cache.capacity
+    assert bigger.count == len(keys)
+    assert all(bigger.get(key) == b"%03d" % i * 25 for i, key in enumerate(keys))
+    assert_consistent(app, bigger)
+    bigger.close()
+
+    # 缩小：按新容量重建后立即淘汰到字节预算以内，被淘汰的文件一并删除
+    smaller = make_cache(app, tmp_path, max_bytes=20_000)
+    assert smaller.capacity < cache.capacity
+    assert smaller.total_bytes <= 20_000 and smaller.count == 20_000 // 75
+    assert_consistent(app, smaller)
+
+def test_lost_index_adopts_existing_files(app, tmp_path):
+    cache = make_cache(app, tmp_path)
+    keys = random_keys(40, seed=6)
+    for key in keys:
+        cache.put(key, b"x" * 10)
+    cache.close()
+    os.remove(cache.index_path)
+    # 超出范围的编号不能被收编（会与其他瓦片混淆）
+    bad = os.path.join(tmp_path, "tiles", str(STYLE), "3", "1", "99.jpg")
+    os.makedirs(os.path.dirname(bad))
+    with open(bad, "wb") as f:
+        f.write(b"bad")
+
+    adopted = make_cache(app, tmp_path)
+    deadline = time.time() + 10
+    while adopted.count < len(keys) and time.time() < deadline:
+        time.sleep(0.05)
+    assert sorted(adopted.keys()) == keys
+    assert adopted.total_bytes == 10 * len(keys)
+
+@pytest.mark.parametrize("key", [(STYLE, 3, 8, 0), (STYLE, 3, 0, -1), (STYLE, 25, 0, 0)])
+def test_pack_tile_key_rejects_out_of_range(app, key):
+    with pytest.raises(ValueError):
+        app.pack_tile_key(key)
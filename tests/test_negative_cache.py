@@ -0,0 +1,48 @@
+"""空白瓦片识别与负缓存"""
+from io import BytesIO
+
+from PIL import Image
+
+def jpeg(color, size=256, quality=90, pad=0):
+    """生成 JPEG，pad 字节填在结束标记之后，用来把大小调到指定区间"""
+    buf = BytesIO()
+    Image.new("RGB", (size, size), color).save(buf, "JPEG", quality=quality)
+    return buf.getvalue() + bytes(pad)
+
+def striped_jpeg():
+    image = Image.new("RGB", (64, 64), (242, 239, 233))
+    for i in range(0, 64, 8):
+        image.paste((40, 40, 40), (i, 0, i + 2, 64))
+    buf = BytesIO()
+    image.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+def key(x):
+    return (7, 14, x, 6000)
+
+def test_short_image_is_rejected_every_time(app, caches):
+    content = jpeg((170, 200, 230), size=16)
+    assert len(content) <= 1000
+    for x in range(5):
+        assert app.check_upstream_tile(key(x), 200, content) is None
+        assert app.negative_cache.get(key(x)) == (True, None)
+    assert not app.negative_cache.blanks
+
+def test_solid_image_is_blank_on_first_sight(app, caches):
+    content = jpeg((170, 200, 230))
+    content += bytes(max(0, 1500 - len(content)))
+    assert 1000 < len(content) <= app.BLANK_TILE_MAX_BYTES
+    first = app.check_upstream_tile(key(0), 200, content)
+    assert isinstance(first, app.BlankTile)
+    for x in range(1, 5):
+        assert app.check_upstream_tile(key(x), 200, content) is first
+        assert app.negative_cache.get(key(x)) == (True, first)
+
+def test_small_detailed_image_is_a_normal_tile(app, caches):
+    content = striped_jpeg()
+    content += bytes(max(0, 1500 - len(content)))
+    assert 1000 < len(content) <= app.BLANK_TILE_MAX_BYTES
+    for x in range(3):
+        data = app.check_upstream_tile(key(x), 200, content)
+        assert data == content and not isinstance(data, app.BlankTile)
+    assert app.negative_cache.get(key(0)) == (False, None)
@@ -0,0 +1,41 @@
+"""像素级重投影"""
+import asyncio
+
+def test_partial_reprojection_is_not_cached(app, caches, upstream):
+    """2-4 张来源瓦片中有缺失时，拼出的半灰瓦片只返回、不缓存"""
+    z, x, y = 12, 3372, 1552
+    grid = app.reprojection_grid(z, x, y)
+    keys = grid.source_keys()
+    assert len(keys) > 1
+    app.negative_cache.put(keys[0], 30)
+    key = (app.TILE_STYLE | app.REPROJECTED_STYLE_FLAG, z, x, y)
+    data = app.load_reprojected_tile(z, x, y)
+    assert isinstance(data, app.FallbackTile)
+    assert key not in app.memory_cache.entries
+    assert not app.tile_cache.contains(key)
+
+    server = app.AsyncTileServer(app.app)
+    data = asyncio.run(server.load_reprojected_tile(z, x, y))
+    assert isinstance(data, app.FallbackTile)
+    assert key not in app.memory_cache.entries
+    assert not app.tile_cache.contains(key)
+
+def test_async_reprojection_reads_disk_and_coalesces(app, caches, upstream, monkeypatch):
+    z, x, y = 12, 3372, 1552
+    key = (app.TILE_STYLE | app.REPROJECTED_STYLE_FLAG, z, x, y)
+    app.tile_cache.put(key, b"\xff\xd8\xffcached")
+    server = app.AsyncTileServer(app.app)
+    assert asyncio.run(server.load_reprojected_tile(z, x, y)) == b"\xff\xd8\xffcached"
+    assert upstream.stats()["requests"] == 0
+
+    warps = []
+    warp_tiles = app.warp_tiles
+    monkeypatch.setattr(app, "warp_tiles", lambda grid, sources: warps.append(1) or warp_tiles(grid, sources))
+    other = (13, 6745, 3105)
+
+    async def load_many():
+        return await asyncio.gather(*(server.load_reprojected_tile(*other) for _ in range(8)))
+
+    results = asyncio.run(load_many())
+    assert len(warps) == 1
+    assert all(result == results[0] and result is not None for result in results)
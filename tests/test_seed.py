@@ -0,0 +1,47 @@
+"""瓦片预热"""
+import pytest
+
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+
+@pytest.fixture
+def counted_limiters(app, monkeypatch):
+    """记录每个限速器放行的请求数"""
+    limiters = []
+
+    class CountingLimiter(app.RateLimiter):
+        def __init__(self, rate):
+            super().__init__(rate)
+            self.acquired = 0
+            limiters.append(self)
+
+        def acquire(self):
+            self.acquired += 1
+            super().acquire()
+
+    monkeypatch.setattr(app, "RateLimiter", CountingLimiter)
+    return limiters
+
+def test_world_bbox_seeds_every_tile(app, caches, upstream, counted_limiters):
+    keys = list(app.enumerate_seed_keys(WORLD, range(0, 3)))
+    assert all(app.valid_tile(z, x, y) for _, z, x, y in keys)
+    counts = app.seed_tiles(iter(keys), len(keys), 4, 1000)
+    assert counts["failed"] == 0
+    assert counts["done"] == counts["fetched"] == len(keys)
+    assert all(app.tile_cache.contains(key) for key in keys)
+    # 每个真正发出的请求都经过了所发往服务器的限速器
+    assert sum(limiter.acquired for limiter in counted_limiters) == upstream.stats()["requests"] == len(keys)
+
+def test_seed_restores_upstream_client(app, caches, upstream):
+    client = app.upstream_client
+    app.seed_tiles(app.enumerate_seed_keys(WORLD, range(0, 1)), 1, 1, 0)
+    assert app.upstream_client is client
+    assert not client.rate_limiters
+
+def test_seed_counts_unexpected_errors_as_failed(app, caches, upstream, monkeypatch):
+    def broken(key, modified_since=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app, "fetch_upstream_tile", broken)
+    keys = list(app.enumerate_seed_keys(WORLD, range(0, 2)))
+    counts = app.seed_tiles(iter(keys), len(keys), 2, 0)
+    assert counts["failed"] == counts["done"] == len(keys)
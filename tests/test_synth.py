@@ -0,0 +1,61 @@
+"""跨级合成与补位瓦片"""
+import asyncio
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+def jpeg(color):
+    buf = BytesIO()
+    Image.new("RGB", (256, 256), color).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+@pytest.fixture
+def fallback_sources(app, caches):
+    """让 (12, 3372, 1552) 重投影所需的上游瓦片都不可用，但它们的父瓦片已缓存：只能得到补位瓦片"""
+    grid = app.reprojection_grid(12, 3372, 1552)
+    for style, z, x, y in grid.source_keys():
+        app.negative_cache.put((style, z, x, y), 60)
+        app.memory_cache.put((style, z - 1, x >> 1, y >> 1), jpeg((200, 30, 30)))
+    return (app.TILE_STYLE | app.REPROJECTED_STYLE_FLAG, 12, 3372, 1552)
+
+def assert_not_cached(app, key):
+    assert key not in app.memory_cache.entries
+    assert not app.tile_cache.contains(key)
+
+def test_reprojection_from_fallback_is_not_cached(app, fallback_sources):
+    data = app.load_reprojected_tile(12, 3372, 1552)
+    assert isinstance(data, app.FallbackTile)
+    assert_not_cached(app, fallback_sources)
+
+def test_async_reprojection_from_fallback_is_not_cached(app, fallback_sources):
+    server = app.AsyncTileServer(app.app)
+    data = asyncio.run(server.load_reprojected_tile(12, 3372, 1552))
+    assert isinstance(data, app.FallbackTile)
+    assert_not_cached(app, fallback_sources)
+
+def test_overzoom_from_fallback_parent_is_not_cached(app, caches, monkeypatch):
+    monkeypatch.setattr(app, "UPSTREAM_MAX_ZOOM", 18)
+    style = app.TILE_STYLE
+    app.memory_cache.put((style, 17, 100, 100), jpeg((30, 200, 30)))
+    app.negative_cache.put((style, 18, 200, 200), 60)
+    key = (style, 19, 400, 400)
+    assert isinstance(app.load_tile(key), app.FallbackTile)
+    assert_not_cached(app, key)
+
+def test_overzoom_pixels_are_continuous_across_tiles(app):
+    ramp = np.tile(np.arange(256, dtype=np.uint8)[None, :, None], (256, 1, 3))
+    buf = BytesIO()
+    Image.fromarray(ramp).save(buf, "PNG")
+    left = app.overzoom_pixels(buf.getvalue(), 1, 0, 0)
+    right = app.overzoom_pixels(buf.getvalue(), 1, 1, 0)
+    assert left.shape == (256, 256, 3)
+    assert abs(int(right[0, 0, 0]) - int(left[0, -1, 0])) <= 1
+
+def test_underzoom_averages_children(app):
+    children = [jpeg(color) for color in ((0, 0, 0), (200, 200, 200), (200, 200, 200), (0, 0, 0))]
+    pixels = app.underzoom_pixels(children)
+    assert pixels.shape == (256, 256, 3)
+    assert abs(int(pixels[0, 0, 0]) - 0) <= 4
+    assert abs(int(pixels[0, 255, 0]) - 200) <= 4
@@ -0,0 +1,42 @@
+"""WGS84 -> GCJ 瓦片映射索引"""
+import threading
+
+def sample_tiles(app, z, step):
+    x0, y0, width, height = app.TileMappingIndex(0, 0)._bounds(z)
+    return [(z, x0 + col, y0 + row) for row in range(0, height, step) for col in range(0, width, step)]
+
+def test_lookup_matches_direct_conversion(app):
+    index = app.TileMappingIndex(10, 100000)
+    tiles = sample_tiles(app, 10, 7) + sample_tiles(app, 12, 23)
+    for z, x, y in tiles:
+        assert index.lookup(z, x, y) == app.wgs84_tile_to_gcj(z, x, y)
+    # 第二次从数组 / 备忘表读取
+    for z, x, y in tiles:
+        assert index.lookup(z, x, y) == app.wgs84_tile_to_gcj(z, x, y)
+    assert index.hits == len(tiles)
+
+def test_prebuild_matches_lazy_fill(app):
+    prebuilt = app.TileMappingIndex(9, 0)
+    prebuilt.prebuild()
+    lazy = app.TileMappingIndex(9, 0)
+    for z in range(10):
+        for tile in sample_tiles(app, z, 3):
+            assert prebuilt.lookup(*tile) == lazy.lookup(*tile)
+
+def test_concurrent_readers_never_see_half_written_entries(app):
+    index = app.TileMappingIndex(11, 0)
+    tiles = sample_tiles(app, 11, 5)
+    expected = {tile: app.wgs84_tile_to_gcj(*tile) for tile in tiles}
+    errors = []
+
+    def worker():
+        for tile in tiles:
+            if index.lookup(*tile) != expected[tile]:
+                errors.append(tile)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors